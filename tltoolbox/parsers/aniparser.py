@@ -22,89 +22,149 @@ freely, subject to the following restrictions:
    distribution.
 '''
 
-import struct
 from collections import OrderedDict
-from dataparser import DataParser
+from dataparser import DataParser, pause_gc, record_type, STORAGE_ARRAY, STORAGE_DICT, STORAGE_RECORD
+from schema import Array, Field, Schema, Struct, Switch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+if numpy is not None:
+    KEY_DTYPE = numpy.dtype([
+        ('time', '<u4'),
+        ('qrotation', '<f4', (4,)),
+        ('position', '<f4', (3,)),
+    ])
+else:
+    KEY_DTYPE = None
+
+
+Quaternion = record_type('Quaternion', ('x', 'y', 'z', 'w'))
+Position = record_type('Position', ('x', 'y', 'z'))
+Key = record_type('Key', ('time', 'qrotation', 'position'))
+Joint = record_type('Joint', ('index', 'key_count', 'keys'))
+
+
+ANI_SCHEMA = Schema([
+    ('header', [
+        Field('id', 'I'),
+        Field('version', 'I'),
+    ]),
+    ('version_header', [
+        Switch('version', {
+            3: [
+                Field('animation_length', 'I'),
+                Field('unused', 'I'),
+                Field('joint_count', 'I'),
+            ],
+            256: [
+                Field('unknown', 'I'),
+                Field('unused', 'I'),
+                Field('animation_length', 'I'),
+                Field('joint_count', 'I'),
+            ],
+        }),
+    ]),
+    ('joints', [
+        Array('joints', 'joint_count', Struct(None, Joint, [
+            Field('index', 'I'),
+            Field('key_count', 'I'),
+            Array('keys', 'key_count', Struct(None, Key, [
+                Field('time', 'I'),
+                Struct('qrotation', Quaternion, [Field('x', 'f'), Field('y', 'f'), Field('z', 'f'), Field('w', 'f')]),
+                Struct('position', Position, [Field('x', 'f'), Field('y', 'f'), Field('z', 'f')]),
+            ]), dtype=KEY_DTYPE),
+        ])),
+    ]),
+])
 
 
 class AniDataException(Exception):
     pass
 
 
+def _key_dicts(keys):
+    """
+    Converts a key array to the OrderedDicts used by dict storage and JSON
+    """
+    result = []
+    for time, (qx, qy, qz, qw), (px, py, pz) in zip(keys['time'].tolist(), keys['qrotation'].tolist(), keys['position'].tolist()):
+        key = OrderedDict()
+        key['time'] = int(time)
+        key['qrotation'] = OrderedDict((('x', qx), ('y', qy), ('z', qz), ('w', qw)))
+        key['position'] = OrderedDict((('x', px), ('y', py), ('z', pz)))
+        result.append(key)
+    return result
+
+
+def _key_array(keys):
+    """
+    Converts keys in the OrderedDict representation to a key array
+    """
+    records = []
+    for key in keys:
+        q = key['qrotation']
+        p = key['position']
+        records.append((key['time'], (q['x'], q['y'], q['z'], q['w']), (p['x'], p['y'], p['z'])))
+    return numpy.array(records, KEY_DTYPE)
+
+
 class Ani(DataParser):
-    def __init__(self):
-        super(Ani, self).__init__()
+    """
+    Parser for .ani animations.
+    With array storage, the keys of each joint are a numpy array of KEY_DTYPE viewing the source data,
+    copy it to make changes. The OrderedDict form of the keys is only produced for JSON output.
+    With record storage, joints and keys are Record instances instead of OrderedDicts.
+    """
+
+    storage_modes = (STORAGE_DICT, STORAGE_ARRAY, STORAGE_RECORD)
+    record_types = (Quaternion, Position, Key, Joint)
+    schema = ANI_SCHEMA
+    file_id = 3
+
+    def __init__(self, storage=STORAGE_DICT, track_changes=False):
+        super(Ani, self).__init__(storage, track_changes)
+
+    def _json_default(self, item):
+        if numpy is not None and isinstance(item, numpy.ndarray) and item.dtype == KEY_DTYPE:
+            return _key_dicts(item)
+        return super(Ani, self)._json_default(item)
 
     def normalize_data(self):
+        if not self.is_dirty('joints'):
+            return
+
         joints = self.data['joints']
         self.data['joint_count'] = len(joints)
         for joint in joints:
             keys = joint['keys']
+            if self.storage == STORAGE_ARRAY and not isinstance(keys, numpy.ndarray):
+                keys = joint['keys'] = _key_array(keys)
             joint['key_count'] = len(keys)
 
+    @pause_gc
     def load_data(self, data):
         self.clear()
 
-        i = 0
-        identifier, version = struct.unpack('<2I', data[i:i + 8])
-        i += 8
+        self._track_source(data)
 
-        if identifier != 3:
-            raise AniDataException("Unknown file ID: {0}".format(identifier))
+        decoder = self.schema.compile(self.storage)
+        offset = self._decode_section(decoder, 'header', data, 0)
 
-        self.data['id'] = identifier
-        self.data['version'] = version
-
-        if version == 3:
-            animation_length, unused, joint_count = struct.unpack('<3I', data[i:i + 12])
-            i += 12
-            if unused != 0xdeadbabe:
-                raise AniDataException("Unexpected data encountered")
-
-            self.data['animation_length'] = animation_length
-            self.data['unused'] = unused
-            self.data['joint_count'] = joint_count
-        elif version == 256:
-            unknown, unused, animation_length, joint_count = struct.unpack('<4I', data[i:i + 16])
-            i += 16
-            if unknown != 0xa9f5d5ce or unused != 0xdeadbabe:
-                raise AniDataException("Unexpected data encountered")
-
-            self.data['unknown'] = unknown
-            self.data['unused'] = unused
-            self.data['animation_length'] = animation_length
-            self.data['joint_count'] = joint_count
-        else:
+        identifier = self.data['id']
+        version = self.data['version']
+
+        if identifier != self.file_id:
+            raise AniDataException("Unknown file ID: {0}".format(identifier))
+        if version not in (3, 256):
             raise AniDataException("Unknown file version: {0}".format(version))
 
-        joints = []
-        for _ in range(joint_count):
-            index, key_count = struct.unpack('<2I', data[i:i + 8])
-            i += 8
-            keys = []
-            joint = OrderedDict()
-            joint['index'] = index
-            joint['key_count'] = key_count
-            for _ in range(key_count):
-                time, qx, qy, qz, qw, px, py, pz = struct.unpack('<I7f', data[i:i + 32])
-                i += 32
-
-                quaternion = OrderedDict()
-                quaternion['x'] = qx
-                quaternion['y'] = qy
-                quaternion['z'] = qz
-                quaternion['w'] = qw
-
-                position = OrderedDict()
-                position['x'] = px
-                position['y'] = py
-                position['z'] = pz
-
-                key = OrderedDict()
-                key['time'] = time
-                key['qrotation'] = quaternion
-                key['position'] = position
-                keys.append(key)
-            joint['keys'] = keys
-            joints.append(joint)
-        self.data['joints'] = joints
+        offset = self._decode_section(decoder, 'version_header', data, offset)
+
+        if self.data['unused'] != 0xdeadbabe or self.data.get('unknown', 0xa9f5d5ce) != 0xa9f5d5ce:
+            raise AniDataException("Unexpected data encountered")
+
+        self._decode_section(decoder, 'joints', data, offset)
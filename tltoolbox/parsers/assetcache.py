@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+# On-disk cache of loaded assets, keyed by a hash of the source data, the parser and the storage mode.
+#
+# Usage: python assetcache.py <cache dir> <file> [<file> ...]
+
+import cPickle
+import errno
+import hashlib
+import os
+import sys
+import tempfile
+
+import assets
+from dataparser import pause_gc, STORAGE_DICT
+
+_SUFFIX = '.pickle'
+
+
+class AssetCache(object):
+    """
+    Caches the loaded data of assets on disk, pickled with cPickle protocol 2.
+    Entries are keyed by the SHA-1 of the source data, the parser class and version, and the storage mode, so
+    changed sources and parsers never hit stale entries. The least recently used entries are removed when the
+    cache grows beyond max_size.
+    Binary data decoded by a compiled schema is as fast to decode again as it is to unpickle, so by default only
+    assets loaded from JSON, or by parsers without a schema, are cached. Lazy parsers and parsers tracking
+    changes need the source data and are never cached.
+    Only use cache directories that are trusted, unpickling can run arbitrary code.
+    """
+
+    def __init__(self, directory, max_size=1024 * 1024 * 1024, cache_binary=False):
+        """
+        :param directory: the cache directory, created if missing
+        :param max_size: the maximum total size of the cache in bytes
+        :param cache_binary: if True, binary data is cached also for parsers with a schema
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.cache_binary = cache_binary
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _key(self, data, parser_class, storage):
+        h = hashlib.sha1()
+        h.update("{0}.{1}\0{2}\0{3}\0".format(parser_class.__module__, parser_class.__name__, parser_class.parser_version, storage))
+        h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def _cacheable(self, parser, is_json):
+        if parser.maps_files or parser.track_changes:
+            return False
+        return is_json or self.cache_binary or parser.schema is None
+
+    @pause_gc
+    def get(self, key):
+        """
+        Returns the cached data for a key, or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        os.utime(path, None)  # the modification time orders entries for eviction
+        return data
+
+    def put(self, key, data):
+        """
+        Stores data for a key, then evicts the least recently used entries if the cache is too large
+        """
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(data, f, 2)
+            os.rename(temp_path, self._path(key))
+        except:
+            os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no larger than max_size
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # removed by another process
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Removes all entries
+        """
+        for name in os.listdir(self.directory):
+            if name.endswith(_SUFFIX):
+                os.remove(os.path.join(self.directory, name))
+
+    def load_bytes(self, data, storage=STORAGE_DICT, **kwargs):
+        """
+        Like assets.load_bytes, using the cache
+        """
+        return self._load(data, False, storage, kwargs)
+
+    def load_json(self, text, storage=STORAGE_DICT, **kwargs):
+        """
+        Like assets.load_json, using the cache
+        """
+        return self._load(text, True, storage, kwargs)
+
+    def open_asset(self, path, storage=STORAGE_DICT, **kwargs):
+        """
+        Like assets.open_asset, using the cache
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        return self._load(data, assets.is_json(data[:assets.PEEK_SIZE]), storage, kwargs)
+
+    def _load(self, data, is_json, storage, kwargs):
+        parser = assets.identify(data[:assets.PEEK_SIZE])(storage, **kwargs)
+        if not self._cacheable(parser, is_json):
+            self._load_parser(parser, data, is_json)
+            return parser
+
+        key = self._key(data, type(parser), storage)
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            parser.data = cached
+            return parser
+
+        self.misses += 1
+        self._load_parser(parser, data, is_json)
+        self.put(key, parser.data)
+        return parser
+
+    @staticmethod
+    def _load_parser(parser, data, is_json):
+        if is_json:
+            parser.load_json(data)
+        else:
+            parser.load_bytes(data)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "Usage: {0} <cache dir> <file> [<file> ...]".format(sys.argv[0])
+        sys.exit(1)
+
+    cache = AssetCache(sys.argv[1])
+    for filename in sys.argv[2:]:
+        asset = cache.open_asset(filename)
+        print "{0}: {1}, version {2}".format(filename, type(asset).__name__, asset.data['version'])
+    print "{0} hits, {1} misses".format(cache.hits, cache.misses)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+# Opens asset files with the parser for their format, chosen from the id the data starts with
+#
+# Usage: python assets.py <file> [<file> ...]
+
+import re
+import struct
+import sys
+
+from aniparser import Ani
+from cirparser import Cir
+from dataparser import DataParserException, STORAGE_DICT
+
+_parsers = {}  # file id -> DataParser subclass
+_JSON_ID = re.compile(r'^\s*\{\s*"id"\s*:\s*(\d+)')  # __str__ always writes the id first
+PEEK_SIZE = 64  # enough data to identify any format, binary or JSON
+
+
+def register_parser(parser_class):
+    """
+    Registers a DataParser subclass for the file id in its file_id attribute
+    """
+    if parser_class.file_id is None:
+        raise DataParserException("{0} does not declare a file_id".format(parser_class.__name__))
+    registered = _parsers.get(parser_class.file_id, None)
+    if registered is not None and registered is not parser_class:
+        raise DataParserException("File id {0} is already registered to {1}".format(parser_class.file_id, registered.__name__))
+    _parsers[parser_class.file_id] = parser_class
+
+
+def get_parser_class(file_id):
+    """
+    Returns the DataParser subclass registered for a file id
+    """
+    try:
+        return _parsers[file_id]
+    except KeyError:
+        raise DataParserException("Unknown file ID: {0}".format(file_id))
+
+
+def is_json(head):
+    """
+    Returns True if data starting with head is JSON rather than binary
+    """
+    return head.lstrip()[:1] == '{'
+
+
+def _json_file_id(text):
+    match = _JSON_ID.match(text)
+    if match is None:
+        raise DataParserException("JSON data does not start with an id")
+    return int(match.group(1))
+
+
+def _binary_file_id(head):
+    if len(head) < 4:
+        raise DataParserException("Data is too short to hold a file id")
+    return struct.unpack_from('<I', head)[0]
+
+
+def identify(head):
+    """
+    Returns the parser class for data given its first bytes, binary or JSON
+    :param head: the start of the data, at least 4 bytes for binary data
+    """
+    if is_json(head):
+        return get_parser_class(_json_file_id(head))
+    return get_parser_class(_binary_file_id(head))
+
+
+def load_bytes(data, storage=STORAGE_DICT, **kwargs):
+    """
+    Decodes binary data with the parser registered for its file id
+    :param storage: the storage mode of the parser
+    :param kwargs: additional arguments for the parser constructor
+    :return: the parser holding the data
+    """
+    parser = get_parser_class(_binary_file_id(data[:4]))(storage, **kwargs)
+    parser.load_bytes(data)
+    return parser
+
+
+def load_json(text, storage=STORAGE_DICT, **kwargs):
+    """
+    Loads a string on the format returned by DataParser.__str__ with the parser registered for its id
+    :param storage: the storage mode of the parser
+    :param kwargs: additional arguments for the parser constructor
+    :return: the parser holding the data
+    """
+    parser = get_parser_class(_json_file_id(text[:PEEK_SIZE]))(storage, **kwargs)
+    parser.load_json(text)
+    return parser
+
+
+def open_asset(path, storage=STORAGE_DICT, **kwargs):
+    """
+    Loads a binary or JSON asset file with the parser registered for its id.
+    Only the first bytes of the file are inspected to choose the parser, the file is parsed once.
+    :param storage: the storage mode of the parser
+    :param kwargs: additional arguments for the parser constructor
+    :return: the parser holding the data
+    """
+    with open(path, 'rb') as f:
+        head = f.read(PEEK_SIZE)
+        if is_json(head):
+            parser = get_parser_class(_json_file_id(head))(storage, **kwargs)
+            f.seek(0)
+            parser.load_json_file(f)
+            return parser
+
+    parser = get_parser_class(_binary_file_id(head))(storage, **kwargs)
+    parser.load_file(path)
+    return parser
+
+
+register_parser(Ani)
+register_parser(Cir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "Usage: {0} <file> [<file> ...]".format(sys.argv[0])
+        sys.exit(1)
+
+    for filename in sys.argv[1:]:
+        asset = open_asset(filename)
+        print "{0}: {1}, version {2}".format(filename, type(asset).__name__, asset.data['version'])
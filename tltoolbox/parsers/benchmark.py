@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+# Benchmarks for the parsers
+#
+# Usage: python benchmark.py xarc-descriptors [--count N]
+#        python benchmark.py pack-memory [--size MB]
+#        python benchmark.py roundtrip [--size MB] [--storage MODES]
+#        python benchmark.py throughput [--size MB] [--storage MODES]
+
+import argparse
+import cStringIO
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from aniparser import Ani
+from cirparser import Cir
+from dataparser import numpy, Record, STORAGE_ARRAY, STORAGE_DICT, STORAGE_RECORD
+from xarcparser import Xarc
+
+STORAGE_MODES = (STORAGE_DICT, STORAGE_RECORD, STORAGE_ARRAY) if numpy is not None else (STORAGE_DICT, STORAGE_RECORD)
+
+
+def make_xarc(filename, count, size=16):
+    """
+    Writes a synthetic archive with count files of size bytes each
+    """
+    xarc = Xarc()
+    data = "\0" * size
+    for n in xrange(count):
+        xarc.insert_data("file{0:06d}.dat".format(n), data)
+    xarc.save(filename)
+
+
+def _floats(rng, count):
+    return [rng.uniform(-100.0, 100.0) for _ in xrange(count)]
+
+
+def _string(rng, prefix):
+    return "{0}{1}".format(prefix, "x" * rng.randint(0, 12))
+
+
+def make_ani(filename, size, version=3, keys=1024, seed=0):
+    """
+    Writes a synthetic animation of about size bytes, made of joints with identical keys
+    """
+    rng = random.Random(seed)
+    key_data = "".join(struct.pack('<I7f', n * 33, *_floats(rng, 7)) for n in xrange(keys))
+    joint_count = max(1, size // (8 + len(key_data)))
+
+    with open(filename, 'wb') as f:
+        if version == 3:
+            f.write(struct.pack('<5I', 3, 3, keys * 33, 0xdeadbabe, joint_count))
+        else:
+            f.write(struct.pack('<6I', 3, version, 0xa9f5d5ce, 0xdeadbabe, keys * 33, joint_count))
+        for n in xrange(joint_count):
+            f.write(struct.pack('<2I', n, keys))
+            f.write(key_data)
+
+
+def make_cir(filename, size, vertices=4096, triangles=4096, faces=64, version=16, seed=0):
+    """
+    Writes a synthetic mesh of about size bytes, made of mesh groups of identical faces
+    """
+    rng = random.Random(seed)
+    vertex_data = "".join(struct.pack('<11f2If', *(_floats(rng, 11) + [rng.randint(0, 7), rng.randint(0, 7), rng.random()]))
+                          for _ in xrange(vertices))
+    triangle_data = "".join(struct.pack('<3I', *[rng.randint(0, vertices - 1) for _ in xrange(3)]) for _ in xrange(triangles))
+    face = struct.pack('<2I', 0, vertices) + vertex_data + struct.pack('<I', triangles) + triangle_data
+    group_size = faces * len(face)
+    groups = max(1, size // group_size)
+
+    def pack_string(value):
+        return struct.pack('<I', len(value)) + value
+
+    with open(filename, 'wb') as f:
+        materials = 2
+        if version == 16:
+            f.write(struct.pack('<2IIfI', 4, 16, 0, rng.random(), materials))
+        else:
+            f.write(struct.pack('<2I2IfI', 4, version, 1, 0, rng.random(), materials))
+        for _ in xrange(materials):
+            f.write(pack_string(_string(rng, "material")) + struct.pack('<I', 0) + pack_string(_string(rng, "texture.dds")))
+            f.write(struct.pack('<3f', *_floats(rng, 3)))
+
+        f.write(struct.pack('<I', 3))
+        for _ in xrange(3):
+            f.write(struct.pack('<4f', *_floats(rng, 4)))
+
+        f.write(struct.pack('<I', 3))
+        for n in xrange(3):
+            children = range(n + 1, 3)
+            f.write(pack_string(_string(rng, "joint")) + struct.pack('<fI', rng.random(), len(children)))
+            f.write(struct.pack('<{0}I'.format(len(children)), *children))
+
+        f.write(struct.pack('<I', groups))
+        for n in xrange(groups):
+            f.write(pack_string("group{0:04d}".format(n)) + struct.pack('<I', faces))
+            for _ in xrange(faces):
+                f.write(face)
+            f.write(struct.pack('<I', 2))
+            for _ in xrange(2):
+                f.write(struct.pack('<4fI', *(_floats(rng, 4) + [rng.randint(0, 9)])))
+            f.write(struct.pack('<I', 2))
+            for _ in xrange(2):
+                f.write(pack_string(_string(rng, "bone")) + struct.pack('<8fI', *(_floats(rng, 8) + [rng.randint(0, 9)])))
+
+
+def make_member_xarc(filename, size, member_size=64 * 1024, seed=0):
+    """
+    Writes a synthetic archive of about size bytes, made of files with distinct random data
+    """
+    rng = random.Random(seed)
+    data = "".join(chr(rng.randint(0, 255)) for _ in xrange(member_size))
+    xarc = Xarc()
+    for n in xrange(max(1, size // member_size)):
+        shift = n % member_size
+        xarc.insert_data("data/file{0:05d}.bin".format(n), data[shift:] + data[:shift])
+    xarc.save(filename)
+
+
+def _legacy_read_file_descs(data, base_offset):
+    """
+    The original character by character file description table parser, kept as a reference
+    """
+    def _get_file_desc(data, offset):
+        name = ""
+        i = offset
+        c = data[i]
+        i += 1
+        while c != '\0':
+            name += c
+            c = data[i]
+            i += 1
+
+        size, unknown = struct.unpack('<2I', data[i:i + 8])
+        i += 8
+        return i - offset, name, size
+
+    file_descs = []
+    i = 12
+    while i < base_offset:
+        file_desc = _get_file_desc(data, i)
+        file_descs.append((file_desc[1], file_desc[2]))
+        i += file_desc[0]
+    return file_descs
+
+
+def _best_of(func, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_xarc_descriptors(count, repeat=3):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.xarc")
+        make_xarc(filename, count)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        base_offset, = struct.unpack_from('<I', data, 8)
+
+        legacy = _best_of(lambda: _legacy_read_file_descs(data, base_offset), repeat)
+        table = _best_of(lambda: Xarc._read_file_descs(data, base_offset), repeat)
+
+        def _open():
+            with Xarc() as xarc:
+                xarc.open(filename)
+        opened = _best_of(_open, repeat)
+
+        print "{0} files, {1} byte table".format(count, base_offset - 12)
+        print "  legacy table parser: {0:8.3f} ms".format(legacy * 1000)
+        print "  table parser:        {0:8.3f} ms ({1:.1f}x)".format(table * 1000, legacy / table)
+        print "  Xarc.open:           {0:8.3f} ms".format(opened * 1000)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _max_rss():
+    """
+    Returns the peak resident set size of this process in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _pack_memory_task(args):
+    filename, output, method = args
+    cir = Cir(STORAGE_ARRAY)
+    cir.load(filename)
+    loaded = _max_rss()
+
+    start = time.time()
+    if method == 'pack_to':
+        with open(output, 'wb') as f:
+            cir.pack_to(f)
+    else:
+        if method == 'generic':
+            cir.schema = None  # fall back to the generic tree walk
+        data = cir.pack()
+        with open(output, 'wb') as f:
+            f.write(data)
+        del data
+    elapsed = time.time() - start
+
+    return loaded, _max_rss(), elapsed
+
+
+def bench_pack_memory(size):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.cir")
+        output = os.path.join(tmpdir, "packed.cir")
+        make_cir(filename, size)
+        file_size = os.path.getsize(filename)
+
+        print "{0:.1f} MB mesh".format(file_size / 1024.0 / 1024.0)
+        for method in ('generic', 'pack', 'pack_to'):
+            # every method runs in a fresh process so that the peak resident set sizes are comparable
+            pool = multiprocessing.Pool(1)
+            try:
+                loaded, peak, elapsed = pool.apply(_pack_memory_task, ((filename, output, method),))
+            finally:
+                pool.terminate()
+
+            with open(filename, 'rb') as a, open(output, 'rb') as b:
+                same = a.read() == b.read()
+
+            print "  {0:8s} {1:8.3f} s, peak {2:8.1f} MB above the loaded mesh{3}".format(
+                method, elapsed, (peak - loaded) / 1024.0 / 1024.0, "" if same else " (OUTPUT DIFFERS)")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _make_assets(tmpdir, size):
+    """
+    Writes the synthetic files of the round trip and throughput benchmarks
+    :return: a list of (label, parser class or Xarc, filename) tuples
+    """
+    assets = []
+    for version in (3, 256):
+        filename = os.path.join(tmpdir, "v{0}.ani".format(version))
+        make_ani(filename, size, version, seed=version)
+        assets.append(("ani v{0}".format(version), Ani, filename))
+    for version in (16, 256):
+        filename = os.path.join(tmpdir, "v{0}.cir".format(version))
+        make_cir(filename, size, vertices=1024, triangles=1024, faces=8, version=version, seed=version)
+        assets.append(("cir v{0}".format(version), Cir, filename))
+    filename = os.path.join(tmpdir, "files.xarc")
+    make_member_xarc(filename, size)
+    assets.append(("xarc", Xarc, filename))
+    return assets
+
+
+def _iter_records(value):
+    """
+    Yields every Record in loaded parser data
+    """
+    if isinstance(value, Record):
+        yield value
+        value = value.values()
+    elif isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, list):
+        return
+    for item in value:
+        for record in _iter_records(item):
+            yield record
+
+
+def _check_parser(parser_class, data, storages):
+    """
+    Yields a description of every failed round trip check of binary data
+    """
+    reference = parser_class(STORAGE_DICT)
+    reference.load_bytes(data)
+    reference_json = str(reference)
+
+    for storage in storages:
+        parser = parser_class(storage)
+        parser.load_bytes(data)
+        if parser.pack() != data:
+            yield "{0}: pack(load(x)) != x".format(storage)
+
+        # records work as mappings even with fields named like mapping methods, such as Joint.keys
+        for record in _iter_records(parser.data):
+            try:
+                ok = record.keys() == list(record._fields) and dict(record) == dict(zip(record._fields, record.values()))
+            except TypeError:
+                ok = False
+            if not ok:
+                yield "{0}: {1} does not work as a mapping".format(storage, type(record).__name__)
+                break
+
+        f = cStringIO.StringIO()
+        parser.pack_to(f)
+        if f.getvalue() != data:
+            yield "{0}: pack_to(load(x)) != x".format(storage)
+
+        text = str(parser)
+        if text != reference_json:
+            yield "{0}: JSON differs from the JSON of dict storage".format(storage)
+
+        reloaded = parser_class(storage)
+        reloaded.load_json(text)
+        if reloaded.pack() != data:
+            yield "{0}: pack(load_json(json(x))) != x".format(storage)
+        if str(reloaded) != text:
+            yield "{0}: json(load_json(json(x))) != json(x)".format(storage)
+
+        f = cStringIO.StringIO()
+        parser.dump_json(f, compact=True)
+        reloaded = parser_class(storage)
+        reloaded.load_json(f.getvalue())
+        if reloaded.pack() != data:
+            yield "{0}: pack(load_json(compact json(x))) != x".format(storage)
+
+        variants = [('track_changes', parser_class(storage, track_changes=True))]
+        if parser_class is Cir:
+            variants.append(('lazy', Cir(storage, lazy=True)))
+        for name, variant in variants:
+            variant.load_bytes(data)
+            if variant.pack() != data:
+                yield "{0}, {1}: pack(load(x)) != x".format(storage, name)
+
+
+def _check_xarc(filename, data):
+    """
+    Yields a description of every failed round trip check of an archive
+    """
+    with Xarc() as xarc:
+        xarc.load(filename)
+        if xarc.pack() != data:
+            yield "pack(load(x)) != x"
+
+    with Xarc() as xarc:
+        xarc.open(filename)
+        if xarc.pack() != data:
+            yield "pack(open(x)) != x"
+
+    # swapping two files of the same size by their zero copy buffers is patched in place by flush
+    with Xarc() as xarc:
+        xarc.open(filename)
+        names = xarc.get_file_names()
+        names = [k for k in names if xarc.get_file_size(k) == xarc.get_file_size(names[0])][:2]
+        expected = dict((k, xarc.get_data(k, copy=True)) for k in names)
+    if len(names) == 2:
+        swapped = filename + ".swap"
+        shutil.copyfile(filename, swapped)
+        with Xarc() as xarc:
+            xarc.open(swapped, update=True)
+            a, b = names
+            data_a = xarc.get_data(a)
+            data_b = xarc.get_data(b)
+            xarc.insert_data(a, data_b)
+            xarc.insert_data(b, data_a)
+            xarc.flush()
+            if xarc.get_data(a, copy=True) != expected[b] or xarc.get_data(b, copy=True) != expected[a]:
+                yield "flush() of swapped zero copy buffers"
+        os.remove(swapped)
+
+
+def check_roundtrip(size, storages=STORAGE_MODES):
+    """
+    Checks that synthetic files of every format are reproduced byte for byte by the parsers
+    :return: True if all checks passed
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        passed = True
+        for label, parser_class, filename in _make_assets(tmpdir, size):
+            with open(filename, 'rb') as f:
+                data = f.read()
+            if parser_class is Xarc:
+                failures = list(_check_xarc(filename, data))
+            else:
+                failures = list(_check_parser(parser_class, data, storages))
+
+            print "{0:10s} {1:8.1f} MB  {2}".format(label, len(data) / 1e6, "ok" if not failures else "FAILED")
+            for failure in failures:
+                print "    " + failure
+            passed = passed and not failures
+        return passed
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _throughput_task(args):
+    """
+    Runs one operation on a file, after loading it if the operation needs loaded data
+    :return: (seconds, peak resident set size increase in bytes)
+    """
+    parser_class, filename, json_filename, storage, operation = args
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    if parser_class is Xarc:
+        parser = Xarc()
+        if operation == 'pack':
+            parser.load(filename)
+    else:
+        parser = parser_class(storage)
+        if operation in ('pack', 'dump_json'):
+            parser.load_bytes(data)
+
+    before = _max_rss()
+    start = time.time()
+    if operation == 'load':
+        if parser_class is Xarc:
+            parser.open(filename)
+            for name in parser.get_file_names():
+                parser.get_data(name, copy=True)
+        else:
+            parser.load_bytes(data)
+    elif operation == 'pack':
+        parser.pack()
+    elif operation == 'dump_json':
+        with open(os.devnull, 'wb') as f:
+            parser.dump_json(f)
+    elif operation == 'load_json':
+        with open(json_filename, 'rb') as f:
+            parser.load_json_file(f)
+    elapsed = time.time() - start
+    return elapsed, _max_rss() - before
+
+
+def bench_throughput(size, storages=STORAGE_MODES):
+    """
+    Reports the throughput and peak memory of loading, packing, and converting synthetic files to and from JSON.
+    Throughput is in MB of binary data per second for every operation.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print "{0:10s} {1:7s} {2:10s} {3:>10s} {4:>12s}".format("format", "storage", "operation", "MB/s", "peak MB")
+        for label, parser_class, filename in _make_assets(tmpdir, size):
+            file_size = os.path.getsize(filename)
+            if parser_class is Xarc:
+                runs = [(None, operation) for operation in ('load', 'pack')]
+            else:
+                runs = [(storage, operation) for storage in storages for operation in ('load', 'pack', 'dump_json', 'load_json')]
+
+            json_filename = filename + ".json"
+            if parser_class is not Xarc:
+                parser = parser_class(STORAGE_ARRAY if numpy is not None else STORAGE_RECORD)
+                parser.load_file(filename)
+                with open(json_filename, 'wb') as f:
+                    parser.dump_json(f)
+                del parser
+
+            for storage, operation in runs:
+                # every operation runs in a fresh process so that the peak resident set sizes are comparable
+                pool = multiprocessing.Pool(1)
+                try:
+                    elapsed, peak = pool.apply(_throughput_task, ((parser_class, filename, json_filename, storage, operation),))
+                finally:
+                    pool.terminate()
+                print "{0:10s} {1:7s} {2:10s} {3:10.1f} {4:12.1f}".format(
+                    label, storage or "-", operation, file_size / 1e6 / max(elapsed, 1e-6), peak / 1e6)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the tltoolbox parsers')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    xarc_descriptors = subparsers.add_parser('xarc-descriptors', help='Parse the file description table of a synthetic archive')
+    xarc_descriptors.add_argument('--count', type=int, default=100000, help='Number of files in the archive')
+    xarc_descriptors.add_argument('--repeat', type=int, default=3, help='Number of timed runs, the best is reported')
+
+    pack_memory = subparsers.add_parser('pack-memory', help='Peak memory of packing a synthetic mesh in memory and to a file')
+    pack_memory.add_argument('--size', type=int, default=256, help='Size of the mesh in MB')
+
+    def storage_modes(value):
+        modes = value.split(',')
+        for mode in modes:
+            if mode not in STORAGE_MODES:
+                raise argparse.ArgumentTypeError("Unknown storage mode '{0}', expected one of: {1}".format(mode, ", ".join(STORAGE_MODES)))
+        return modes
+
+    roundtrip = subparsers.add_parser('roundtrip', help='Check that synthetic files of every format round trip byte for byte, through binary and JSON')
+    roundtrip.add_argument('--size', type=float, default=0.5, help='Size of each file in MB')
+    roundtrip.add_argument('--storage', type=storage_modes, default=STORAGE_MODES, help='Comma separated storage modes to check')
+
+    throughput = subparsers.add_parser('throughput', help='Throughput and peak memory of load, pack, JSON dump and JSON load')
+    throughput.add_argument('--size', type=float, default=4, help='Size of each file in MB')
+    throughput.add_argument('--storage', type=storage_modes, default=[STORAGE_RECORD] + ([STORAGE_ARRAY] if numpy is not None else []),
+                            help='Comma separated storage modes to measure. dict storage is left out by default, it is slow')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'xarc-descriptors':
+        bench_xarc_descriptors(args.count, args.repeat)
+    elif args.benchmark == 'pack-memory':
+        bench_pack_memory(args.size * 1024 * 1024)
+    elif args.benchmark == 'roundtrip':
+        if not check_roundtrip(int(args.size * 1024 * 1024), args.storage):
+            sys.exit(1)
+    elif args.benchmark == 'throughput':
+        bench_throughput(int(args.size * 1024 * 1024), args.storage)
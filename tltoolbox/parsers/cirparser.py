@@ -22,39 +22,264 @@ freely, subject to the following restrictions:
    distribution.
 '''
 
-import struct
 from collections import OrderedDict
-from dataparser import DataParser
+import multiprocessing.pool
+import struct
+from dataparser import DataParser, LazySequence, pause_gc, record_type, STORAGE_ARRAY, STORAGE_DICT, STORAGE_RECORD
+from schema import Array, Field, Schema, String, Struct, Switch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+if numpy is not None:
+    VERTEX_DTYPE = numpy.dtype([
+        ('position_joint1', '<f4', (3,)),
+        ('position_joint2', '<f4', (3,)),
+        ('normal', '<f4', (3,)),
+        ('uv', '<f4', (2,)),
+        ('joint1', '<u4'),
+        ('joint2', '<u4'),
+        ('weight', '<f4'),
+    ])
+    TRIANGLE_DTYPE = numpy.dtype('<u4')
+else:
+    VERTEX_DTYPE = None
+    TRIANGLE_DTYPE = None
+
+
+Color = record_type('Color', ('r', 'g', 'b'))
+Material = record_type('Material', ('name_length', 'name', 'unknown', 'texture_name_length', 'texture_name', 'color'))
+Unknown = record_type('Unknown', ('unknown1', 'unknown2', 'unknown3', 'unknown4'))
+Joint = record_type('Joint', ('name_length', 'name', 'unknown', 'child_count', 'children'))
+Vector3 = record_type('Vector3', ('x', 'y', 'z'))
+UV = record_type('UV', ('u', 'v'))
+Vertex = record_type('Vertex', ('position_joint1', 'position_joint2', 'normal', 'uv', 'joint1', 'joint2', 'weight'))
+Face = record_type('Face', ('material_index', 'vertex_count', 'vertices', 'triangle_count', 'triangles'))
+MeshGroupUnknown1 = record_type('MeshGroupUnknown1', ('unknown1', 'unknown2', 'unknown3', 'unknown4', 'unknown5'))
+MeshGroupUnknown2 = record_type('MeshGroupUnknown2', ('name_length', 'name', 'unknown1', 'unknown2', 'unknown3', 'unknown4',
+                                                      'unknown5', 'unknown6', 'unknown7', 'unknown8', 'unknown9'))
+MeshGroup = record_type('MeshGroup', ('name_length', 'name', 'face_count', 'faces', 'unknown1_count', 'unknowns1', 'unknown2_count', 'unknowns2'))
+
+
+def _vector3(name):
+    return Struct(name, Vector3, [Field('x', 'f'), Field('y', 'f'), Field('z', 'f')])
+
+
+CIR_SCHEMA = Schema([
+    ('header', [
+        Field('id', 'I'),
+        Field('version', 'I'),
+    ]),
+    ('version_header', [
+        Switch('version', {
+            16: [
+                Field('unused', 'I'),
+                Field('unknown2', 'f'),
+                Field('material_count', 'I'),
+            ],
+            256: [
+                Field('unknown1', 'I'),
+                Field('unused', 'I'),
+                Field('unknown2', 'f'),
+                Field('material_count', 'I'),
+            ],
+        }),
+    ]),
+    ('materials', [
+        Array('materials', 'material_count', Struct(None, Material, [
+            Field('name_length', 'I'),
+            String('name', 'name_length'),
+            Field('unknown', 'I'),
+            Field('texture_name_length', 'I'),
+            String('texture_name', 'texture_name_length'),
+            Struct('color', Color, [Field('r', 'f'), Field('g', 'f'), Field('b', 'f')]),
+        ])),
+    ]),
+    ('unknowns', [
+        Field('unknown_count', 'I'),
+        Array('unknowns', 'unknown_count', Struct(None, Unknown, [
+            Field('unknown1', 'f'),
+            Field('unknown2', 'f'),
+            Field('unknown3', 'f'),
+            Field('unknown4', 'f'),
+        ])),
+    ]),
+    ('joints', [
+        Field('joint_count', 'I'),
+        Array('joints', 'joint_count', Struct(None, Joint, [
+            Field('name_length', 'I'),
+            String('name', 'name_length'),
+            Field('unknown', 'f'),
+            Field('child_count', 'I'),
+            Array('children', 'child_count', 'I'),
+        ])),
+    ]),
+    ('mesh_groups', [
+        Field('mesh_group_count', 'I'),
+        Array('mesh_groups', 'mesh_group_count', Struct(None, MeshGroup, [
+            Field('name_length', 'I'),
+            String('name', 'name_length'),
+            Field('face_count', 'I'),
+            Array('faces', 'face_count', Struct(None, Face, [
+                Field('material_index', 'I'),
+                Field('vertex_count', 'I'),
+                Array('vertices', 'vertex_count', Struct(None, Vertex, [
+                    _vector3('position_joint1'),
+                    _vector3('position_joint2'),
+                    _vector3('normal'),
+                    Struct('uv', UV, [Field('u', 'f'), Field('v', 'f')]),
+                    Field('joint1', 'I'),
+                    Field('joint2', 'I'),
+                    Field('weight', 'f'),
+                ]), dtype=VERTEX_DTYPE),
+                Field('triangle_count', 'I'),
+                Array('triangles', 'triangle_count', '3I', dtype=TRIANGLE_DTYPE),
+            ])),
+            Field('unknown1_count', 'I'),
+            Array('unknowns1', 'unknown1_count', Struct(None, MeshGroupUnknown1, [
+                Field('unknown1', 'f'),
+                Field('unknown2', 'f'),
+                Field('unknown3', 'f'),
+                Field('unknown4', 'f'),
+                Field('unknown5', 'I'),
+            ])),
+            Field('unknown2_count', 'I'),
+            Array('unknowns2', 'unknown2_count', Struct(None, MeshGroupUnknown2, [
+                Field('name_length', 'I'),
+                String('name', 'name_length'),
+                Field('unknown1', 'f'),
+                Field('unknown2', 'f'),
+                Field('unknown3', 'f'),
+                Field('unknown4', 'f'),
+                Field('unknown5', 'f'),
+                Field('unknown6', 'f'),
+                Field('unknown7', 'f'),
+                Field('unknown8', 'f'),
+                Field('unknown9', 'I'),
+            ])),
+        ])),
+    ]),
+])
 
 
 class CirDataException(Exception):
     pass
 
 
+def _vertex_dicts(vertices):
+    """
+    Converts a vertex array to the OrderedDicts used by dict storage and JSON
+    """
+    result = []
+    for (x1, y1, z1), (x2, y2, z2), (nx, ny, nz), (u, v), joint1, joint2, weight in zip(
+            vertices['position_joint1'].tolist(), vertices['position_joint2'].tolist(), vertices['normal'].tolist(),
+            vertices['uv'].tolist(), vertices['joint1'].tolist(), vertices['joint2'].tolist(), vertices['weight'].tolist()):
+        vertex = OrderedDict()
+        vertex['position_joint1'] = OrderedDict((('x', x1), ('y', y1), ('z', z1)))
+        vertex['position_joint2'] = OrderedDict((('x', x2), ('y', y2), ('z', z2)))
+        vertex['normal'] = OrderedDict((('x', nx), ('y', ny), ('z', nz)))
+        vertex['uv'] = OrderedDict((('u', u), ('v', v)))
+        vertex['joint1'] = int(joint1)
+        vertex['joint2'] = int(joint2)
+        vertex['weight'] = weight
+        result.append(vertex)
+    return result
+
+
+def _vertex_array(vertices):
+    """
+    Converts vertices in the OrderedDict representation to a vertex array
+    """
+    records = []
+    for vertex in vertices:
+        p1 = vertex['position_joint1']
+        p2 = vertex['position_joint2']
+        n = vertex['normal']
+        uv = vertex['uv']
+        records.append(((p1['x'], p1['y'], p1['z']), (p2['x'], p2['y'], p2['z']), (n['x'], n['y'], n['z']), (uv['u'], uv['v']),
+                        vertex['joint1'], vertex['joint2'], vertex['weight']))
+    return numpy.array(records, VERTEX_DTYPE)
+
+
+@pause_gc
+def _decode_mesh_group_task(args):
+    storage, data = args
+    return CIR_SCHEMA.compile(storage).decoder(MeshGroup)(data, 0)[0]
+
+
 class Cir(DataParser):
-    def __init__(self):
-        super(Cir, self).__init__()
+    """
+    Parser for .cir meshes.
+    With array storage, the vertices of each face are a numpy array of VERTEX_DTYPE and its triangles an
+    (n, 3) array of TRIANGLE_DTYPE. Arrays decoded from binary data view the source data and are read-only,
+    copy them to make changes.
+    With record storage, everything below the top level is made of Record instances instead of OrderedDicts,
+    and triangles are tuples.
+    When lazy, mesh groups are only located when loading binary data, 'mesh_groups' is a LazySequence
+    decoding each group on first access. Files are memory mapped so that undecoded groups are never read.
+    When tracking changes, edits inside large sections have to be marked with mark_dirty, for example
+    mark_dirty('mesh_groups') after changing a vertex. Sections that are neither marked nor found modified by
+    is_dirty are copied from the loaded data by pack and pack_to, and are skipped by normalize_data.
+    """
+
+    storage_modes = (STORAGE_DICT, STORAGE_ARRAY, STORAGE_RECORD)
+    record_types = (Color, Material, Unknown, Joint, Vector3, UV, Vertex, Face, MeshGroupUnknown1, MeshGroupUnknown2, MeshGroup)
+    schema = CIR_SCHEMA
+    file_id = 4
+
+    def __init__(self, storage=STORAGE_DICT, lazy=False, track_changes=False, pool=None):
+        """
+        :param storage: how loaded data is represented, one of storage_modes
+        :param lazy: if True, mesh groups are decoded on first access
+        :param track_changes: if True, only sections that are dirty according to is_dirty are encoded when packing
+        :param pool: a multiprocessing Pool or ThreadPool decoding the mesh groups of binary data in parallel,
+                     unless lazy. Groups are located first, then decoded by the pool and assembled in file order.
+                     Decoded groups are pickled back from worker processes and threads share the interpreter lock,
+                     so a pool only pays off with many CPUs and large groups.
+        """
+        super(Cir, self).__init__(storage, track_changes)
+        self.lazy = lazy
+        self.maps_files = lazy
+        self.pool = pool
+
+    def _json_default(self, item):
+        if numpy is not None and isinstance(item, numpy.ndarray) and item.dtype == VERTEX_DTYPE:
+            return _vertex_dicts(item)
+        return super(Cir, self)._json_default(item)
 
     def normalize_data(self):
-        materials = self.data['materials']
-        self.data['material_count'] = len(materials)
+        if self.is_dirty('materials'):
+            materials = self.data['materials']
+            self.data['material_count'] = len(materials)
+
+            for material in materials:
+                material['name_length'] = len(material['name'])
+                material['texture_name_length'] = len(material['texture_name'])
 
-        for material in materials:
-            material['name_length'] = len(material['name'])
-            material['texture_name_length'] = len(material['texture_name'])
+        if self.is_dirty('unknowns'):
+            self.data['unknown_count'] = len(self.data['unknowns'])
 
-        self.data['unknown_count'] = len(self.data['unknowns'])
+        if self.is_dirty('joints'):
+            joints = self.data['joints']
+            self.data['joint_count'] = len(joints)
 
-        joints = self.data['joints']
-        self.data['joint_count'] = len(joints)
+            for joint in joints:
+                joint['name_length'] = len(joint['name'])
+                joint['child_count'] = len(joint['children'])
 
-        for joint in joints:
-            joint['name_length'] = len(joint['name'])
-            joint['child_count'] = len(joint['children'])
+        if self.is_dirty('mesh_groups'):
+            self._normalize_mesh_groups()
 
+    def _normalize_mesh_groups(self):
         mesh_groups = self.data['mesh_groups']
         self.data['mesh_group_count'] = len(mesh_groups)
 
+        if isinstance(mesh_groups, LazySequence):
+            mesh_groups = mesh_groups.iter_decoded()  # undecoded groups are unchanged
+
         for mesh_group in mesh_groups:
             mesh_group['name_length'] = len(mesh_group['name'])
 
@@ -62,262 +287,76 @@ class Cir(DataParser):
             mesh_group['face_count'] = len(faces)
 
             for face in faces:
+                if self.storage == STORAGE_ARRAY:
+                    if not isinstance(face['vertices'], numpy.ndarray):
+                        face['vertices'] = _vertex_array(face['vertices'])
+                    face['triangles'] = numpy.asarray(face['triangles'], TRIANGLE_DTYPE).reshape(-1, 3)
+
                 face['vertex_count'] = len(face['vertices'])
                 face['triangle_count'] = len(face['triangles'])
 
             mesh_group['unknown1_count'] = len(mesh_group['unknowns1'])
-            mesh_group['unknown2_count'] = len(mesh_group['unknowns2'])
 
+            unknowns2 = mesh_group['unknowns2']
+            mesh_group['unknown2_count'] = len(unknowns2)
+
+            for unknown in unknowns2:
+                unknown['name_length'] = len(unknown['name'])
+
+    @pause_gc
     def load_data(self, data):
         self.clear()
 
-        i = 0
-        identifier, version = struct.unpack('<2I', data[i:i + 8])
-        i += 8
+        self._track_source(data)
 
-        self.data['id'] = identifier
-        self.data['version'] = version
+        decoder = self.schema.compile(self.storage)
+        offset = self._decode_section(decoder, 'header', data, 0)
 
-        if identifier != 4:
-            raise CirDataException("Unknown file ID: {0}".format(identifier))
+        identifier = self.data['id']
+        version = self.data['version']
 
-        if version == 16:
-            unused, unknown2, material_count = struct.unpack('<IfI', data[i:i + 12])
-            i += 12
-            self.data['unused'] = unused
-            self.data['unknown2'] = unknown2
-            self.data['material_count'] = material_count
-        elif version == 256:
-            unknown1, unused, unknown2, material_count = struct.unpack('<2IfI', data[i:i + 16])
-            i += 16
-            self.data['unknown1'] = unknown1
-            self.data['unused'] = unused
-            self.data['unknown2'] = unknown2
-            self.data['material_count'] = material_count
-        else:
+        if identifier != self.file_id:
+            raise CirDataException("Unknown file ID: {0}".format(identifier))
+        if version not in (16, 256):
             raise CirDataException("Unknown file version: {0}".format(version))
 
-        materials = []
-        for _ in range(material_count):
-            material = OrderedDict()
-
-            name_length, = struct.unpack('<I', data[i:i + 4])
-            i += 4
-
-            name, = struct.unpack('<{0}s'.format(name_length), data[i:i + name_length])
-            i += name_length
-
-            unknown, texture_name_length, = struct.unpack('<2I', data[i:i + 8])
-            i += 8
-
-            texture_name, = struct.unpack('<{0}s'.format(texture_name_length), data[i:i + texture_name_length])
-            i += texture_name_length
-
-            r, g, b = struct.unpack('<3f', data[i:i + 12])
-            i += 12
-
-            material['name_length'] = name_length
-            material['name'] = name
-            material['unknown'] = unknown
-            material['texture_name_length'] = texture_name_length
-            material['texture_name'] = texture_name
-
-            color = OrderedDict()
-            color['r'] = r
-            color['g'] = g
-            color['b'] = b
-
-            material['color'] = color
-
-            materials.append(material)
-
-        self.data['materials'] = materials
-
-        unknown_count, = struct.unpack('<I', data[i:i + 4])
-        i += 4
-
-        self.data['unknown_count'] = unknown_count
-
-        unknowns = []
-        for _ in range(unknown_count):
-            unknown = OrderedDict()
-            unknown1, unknown2, unknown3, unknown4 = struct.unpack('<4f', data[i:i + 16])
-            i += 16
-
-            unknown['unknown1'] = unknown1
-            unknown['unknown2'] = unknown2
-            unknown['unknown3'] = unknown3
-            unknown['unknown4'] = unknown4
-            unknowns.append(unknown)
-        self.data['unknowns'] = unknowns
-
-        joint_count, = struct.unpack('<I', data[i:i + 4])
-        i += 4
-
-        self.data['joint_count'] = joint_count
-
-        joints = []
-        for _ in range(joint_count):
-            name_length, = struct.unpack('<I', data[i:i + 4])
-            i += 4
-
-            name, = struct.unpack('<{0}s'.format(name_length), data[i:i + name_length])
-            i += name_length
-
-            unknown, child_count = struct.unpack('<fI', data[i:i + 8])
-            i += 8
-
-            children = list(struct.unpack('<{0}I'.format(child_count), data[i:i + child_count * 4]))
-            i += child_count * 4
-
-            joint = OrderedDict()
-            joint['name_length'] = name_length
-            joint['name'] = name
-            joint['unknown'] = unknown
-            joint['child_count'] = child_count
-            joint['children'] = children
-
-            joints.append(joint)
-
-        self.data['joints'] = joints
-
-        mesh_group_count, = struct.unpack('<I', data[i:i + 4])
-        i += 4
-
-        self.data['mesh_group_count'] = mesh_group_count
-
-        mesh_groups = []
-        for _ in range(mesh_group_count):
-            name_length, = struct.unpack('<I', data[i:i + 4])
-            i += 4
-
-            name, = struct.unpack('<{0}s'.format(name_length), data[i:i + name_length])
-            i += name_length
-
-            face_count, = struct.unpack('<I', data[i:i + 4])
-            i += 4
-
-            mesh_group = OrderedDict()
-            mesh_group['name_length'] = name_length
-            mesh_group['name'] = name
-            mesh_group['face_count'] = face_count
-
-            faces = []
-            for _ in range(face_count):
-                material_index, vertex_count = struct.unpack('<2I', data[i:i + 8])
-                i += 8
-
-                face = OrderedDict()
-                face['material_index'] = material_index
-                face['vertex_count'] = vertex_count
-
-                vertices = []
-                for _ in range(vertex_count):
-                    x1, y1, z1, x2, y2, z2, nx, ny, nz, u, v, joint1, joint2, weight = struct.unpack('<11f2If', data[i:i + 56])
-                    i += 56
-
-                    vertex = OrderedDict()
-                    position_joint1 = OrderedDict()
-                    position_joint1['x'] = x1
-                    position_joint1['y'] = y1
-                    position_joint1['z'] = z1
-                    vertex['position_joint1'] = position_joint1
-
-                    position_joint2 = OrderedDict()
-                    position_joint2['x'] = x2
-                    position_joint2['y'] = y2
-                    position_joint2['z'] = z2
-                    vertex['position_joint2'] = position_joint2
-
-                    normal = OrderedDict()
-                    normal['x'] = nx
-                    normal['y'] = ny
-                    normal['z'] = nz
-                    vertex['normal'] = normal
-
-                    uv = OrderedDict()
-                    uv['u'] = u
-                    uv['v'] = v
-                    vertex['uv'] = uv
-
-                    vertex['joint1'] = joint1
-                    vertex['joint2'] = joint2
-                    vertex['weight'] = weight
-
-                    vertices.append(vertex)
-
-                face['vertices'] = vertices
-
-                triangle_count, = struct.unpack('<I', data[i:i + 4])
-                i += 4
-
-                face['triangle_count'] = triangle_count
-
-                triangles = []
-                for _ in range(triangle_count):
-                    v1, v2, v3 = struct.unpack('<3I', data[i:i + 12])
-                    i += 12
-                    triangle = [v1, v2, v3]
-                    triangles.append(triangle)
-                face['triangles'] = triangles
-
-                faces.append(face)
-
-            mesh_group['faces'] = faces
-
-            unknown1_count, = struct.unpack('<I', data[i:i + 4])
-            i += 4
-
-            mesh_group['unknown1_count'] = unknown1_count
-
-            unknowns1 = []
-            for _ in range(unknown1_count):
-                unknown1, unknown2, unknown3, unknown4, unknown5 = struct.unpack('<4fI', data[i:i + 20])
-                i += 20
-
-                unknown = OrderedDict()
-                unknown['unknown1'] = unknown1
-                unknown['unknown2'] = unknown2
-                unknown['unknown3'] = unknown3
-                unknown['unknown4'] = unknown4
-                unknown['unknown5'] = unknown5
-                unknowns1.append(unknown)
-
-            mesh_group['unknowns1'] = unknowns1
-
-            unknown2_count, = struct.unpack('<I', data[i:i + 4])
-            i += 4
-
-            mesh_group['unknown2_count'] = unknown2_count
-
-            unknowns2 = []
-            for _ in range(unknown2_count):
-                name_length = struct.unpack('<I', data[i:i + 4])
-                i += 4
-
-                name = struct.unpack('<{0}s'.format(name_length), data[i:i + name_length])
-                i += name_length
-
-                unknown1, unknown2, unknown3, unknown4, unknown5, unknown6, unknown7, unknown8, unknown9 = struct.unpack('<8fI', data[i:i + 36])
-                i += 36
-
-                unknown = OrderedDict()
-
-                unknown['name_length'] = name_length
-                unknown['name'] = name
-                unknown['unknown1'] = unknown1
-                unknown['unknown2'] = unknown2
-                unknown['unknown3'] = unknown3
-                unknown['unknown4'] = unknown4
-                unknown['unknown5'] = unknown5
-                unknown['unknown6'] = unknown6
-                unknown['unknown7'] = unknown7
-                unknown['unknown8'] = unknown8
-                unknown['unknown9'] = unknown9
-
-                unknowns2.append(unknown)
-
-            mesh_group['unknowns2'] = unknowns2
-            mesh_groups.append(mesh_group)
-
-        self.data['mesh_groups'] = mesh_groups
+        offset = self._decode_section(decoder, 'version_header', data, offset)
+
+        for section in ('materials', 'unknowns', 'joints'):
+            offset = self._decode_section(decoder, section, data, offset)
+
+        if self.lazy or self.pool is not None:
+            start = offset
+            mesh_group_count, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            self.data['mesh_group_count'] = mesh_group_count
+
+            skip_mesh_group = decoder.skipper(MeshGroup)
+            ranges = []
+            for _ in xrange(mesh_group_count):
+                group_start = offset
+                offset = skip_mesh_group(data, offset)
+                ranges.append((group_start, offset))
+
+            if self.lazy:
+                self.data['mesh_groups'] = LazySequence(data, ranges, self._decode_mesh_group)
+            else:
+                self.data['mesh_groups'] = self._decode_mesh_groups(data, ranges)
+            self._loaded_section('mesh_groups', start, offset)
+        else:
+            self._decode_section(decoder, 'mesh_groups', data, offset)
+
+    def _decode_mesh_groups(self, data, ranges):
+        """
+        Decodes the mesh groups at the given byte ranges on the pool, in order
+        """
+        if isinstance(self.pool, multiprocessing.pool.ThreadPool):
+            decode_mesh_group = self.schema.compile(self.storage).decoder(MeshGroup)
+            return self.pool.map(lambda group_range: decode_mesh_group(data, group_range[0])[0], ranges)
+
+        # worker processes get a copy of the data of each group, and send back the decoded group
+        return self.pool.map(_decode_mesh_group_task, [(self.storage, data[group_start:group_end]) for group_start, group_end in ranges])
+
+    @pause_gc
+    def _decode_mesh_group(self, data, offset):
+        return self.schema.compile(self.storage).decoder(MeshGroup)(data, offset)[0]
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+# Converts .ani and .cir files between the binary format and JSON, in parallel.
+# Binary files are converted to <name>.json, and <name>.json files back to <name>.
+# A manifest of source hashes lets interrupted or repeated runs skip work that is already done.
+#
+# Usage: python convert.py <file or directory> [...] -o <output dir> [-j N] [--xarc] [--manifest FILE]
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+
+import assets
+from dataparser import numpy, STORAGE_ARRAY, STORAGE_RECORD
+from xarcparser import Xarc, member_path, replace_mode
+
+BINARY_EXTENSIONS = ('.ani', '.cir')
+JSON_EXTENSION = '.json'
+XARC_EXTENSION = '.xarc'
+MANIFEST_NAME = '.convert-manifest.json'
+_MANIFEST_SAVE_INTERVAL = 100  # results between manifest saves
+_TEMP_SUFFIX = '.tmp'
+_RESULT_TIMEOUT = 1.0  # seconds, Python 2 only delivers Ctrl-C to a process waiting on a pool with a timeout
+
+# Binary data is decoded with the fastest storage, JSON output is the same for all of them
+_BINARY_STORAGE = STORAGE_ARRAY if numpy is not None else STORAGE_RECORD
+_JSON_STORAGE = STORAGE_RECORD
+
+_archives = {}  # archive path -> open Xarc, per worker process
+
+
+class ConvertTask(object):
+    """
+    A file, or a member of an archive, to convert
+    """
+
+    __slots__ = ('source_id', 'path', 'member', 'output', 'to_json', 'previous_hash', 'compact')
+
+    def __init__(self, source_id, path, member, output, to_json, previous_hash=None, compact=False):
+        self.source_id = source_id
+        self.path = path
+        self.member = member
+        self.output = output
+        self.to_json = to_json
+        self.previous_hash = previous_hash
+        self.compact = compact
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def _output_name(name):
+    """
+    Returns the name of the converted file for a file name, and whether it is converted to JSON, or None
+    """
+    base, ext = os.path.splitext(name)
+    if ext.lower() in BINARY_EXTENSIONS:
+        return name + JSON_EXTENSION, True
+    if ext.lower() == JSON_EXTENSION and os.path.splitext(base)[1].lower() in BINARY_EXTENSIONS:
+        return base, False
+    return None
+
+
+def find_tasks(inputs, output_dir, include_xarc=False):
+    """
+    Yields a ConvertTask for every convertible file below the inputs, and for the members of archives if include_xarc
+    :param inputs: file and directory paths
+    :param output_dir: converted files get the same path below output_dir as their source has below its input
+    """
+    for root in inputs:
+        if os.path.isdir(root):
+            paths = []
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames.sort()
+                paths.extend(os.path.join(dirpath, filename) for filename in sorted(filenames))
+            base = root
+        else:
+            paths = [root]
+            base = os.path.dirname(root)
+
+        for path in paths:
+            rel = os.path.relpath(path, base)
+            if include_xarc and path.lower().endswith(XARC_EXTENSION):
+                archive_dir = os.path.join(output_dir, os.path.splitext(rel)[0])
+                with Xarc() as xarc:
+                    xarc.open(path)
+                    names = xarc.get_file_names()
+                for name in names:
+                    converted = _output_name(name)
+                    if converted is not None:
+                        yield ConvertTask("{0}:{1}".format(os.path.abspath(path), name), path, name,
+                                          member_path(archive_dir, converted[0]), converted[1])
+                continue
+
+            converted = _output_name(os.path.basename(path))
+            if converted is not None:
+                yield ConvertTask(os.path.abspath(path), path, None,
+                                  os.path.join(output_dir, os.path.dirname(rel), converted[0]), converted[1])
+
+
+def is_up_to_date(task):
+    """
+    Returns True if the output of a task exists and is newer than its source
+    """
+    try:
+        return os.stat(task.output).st_mtime >= os.stat(task.path).st_mtime
+    except OSError:
+        return False
+
+
+def _read_source(task):
+    if task.member is None:
+        with open(task.path, 'rb') as f:
+            return f.read()
+
+    xarc = _archives.get(task.path, None)
+    if xarc is None:
+        xarc = _archives[task.path] = Xarc()
+        xarc.open(task.path)
+    return xarc.get_data(task.member, copy=True)
+
+
+def _temp_prefix(output):
+    """
+    Returns the file name prefix of the temporary files an output is written to
+    """
+    return '.' + os.path.basename(output) + '.'
+
+
+def _write_output(task, parser):
+    dirname = os.path.dirname(task.output)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:  # created concurrently
+            if not os.path.isdir(dirname):
+                raise
+
+    # write to a temporary file first, so that interrupted runs never leave partial outputs behind
+    fd, temp_path = tempfile.mkstemp(suffix=_TEMP_SUFFIX, prefix=_temp_prefix(task.output), dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if task.to_json:
+                parser.dump_json(f, task.compact)
+            else:
+                parser.pack_to(f)
+        os.chmod(temp_path, replace_mode(task.output))
+        os.rename(temp_path, task.output)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def convert(task):
+    """
+    Converts the source of a task unless its hash matches the previous hash and the output exists
+    :return: a (task, status, source hash, source size, error message) tuple, status is 'converted', 'unchanged' or 'failed'
+    """
+    try:
+        data = _read_source(task)
+        digest = hashlib.sha1(data).hexdigest()
+
+        if digest == task.previous_hash and os.path.exists(task.output):
+            os.utime(task.output, None)  # up to date by mtime on the next run
+            return task, 'unchanged', digest, len(data), None
+
+        if task.to_json:
+            parser = assets.load_bytes(data, _BINARY_STORAGE)
+        else:
+            parser = assets.load_json(data, _JSON_STORAGE)
+        _write_output(task, parser)
+        return task, 'converted', digest, len(data), None
+    except Exception as e:  # reported per file, one bad file does not stop the run
+        return task, 'failed', None, 0, "{0}: {1}".format(type(e).__name__, e)
+
+
+def _init_worker():
+    """
+    Ctrl-C is handled by the parent process alone, which saves the manifest and terminates the workers
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _remove_partial_outputs(tasks):
+    """
+    Removes the temporary files left behind by workers terminated while writing the outputs of tasks
+    """
+    prefixes = {}  # directory -> temporary file name prefixes
+    for task in tasks:
+        prefixes.setdefault(os.path.dirname(task.output), []).append(_temp_prefix(task.output))
+
+    for dirname, names in prefixes.iteritems():
+        try:
+            filenames = os.listdir(dirname)
+        except OSError:  # never created
+            continue
+        names = tuple(names)
+        for filename in filenames:
+            if filename.startswith(names) and filename.endswith(_TEMP_SUFFIX):
+                try:
+                    os.remove(os.path.join(dirname, filename))
+                except OSError:
+                    pass
+
+
+def load_manifest(filename):
+    """
+    Returns the manifest entries, source id -> {'hash': ..., 'output': ..., 'compact': ...}
+    """
+    try:
+        with open(filename, 'rb') as f:
+            return json.load(f)['sources']
+    except IOError:
+        return {}
+
+
+def save_manifest(filename, entries):
+    """
+    Atomically replaces the manifest
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+    with os.fdopen(fd, 'wb') as f:
+        json.dump({'version': 1, 'sources': entries}, f, sort_keys=True)
+    os.chmod(temp_path, replace_mode(filename))
+    os.rename(temp_path, filename)
+
+
+def convert_all(inputs, output_dir, jobs=None, include_xarc=False, manifest=None, force=False, verbose=False, compact=False):
+    """
+    Converts every file below the inputs with a pool of worker processes
+    :param compact: if True, JSON is written without whitespace and with short floats, see DataParser.dump_json
+    :param manifest: the manifest path, defaults to a file in output_dir
+    :param force: if True, outputs are rewritten even if they are up to date
+    :return: a dict of counts per status, including 'skipped' for outputs that were up to date
+    """
+    manifest = manifest or os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    entries = load_manifest(manifest)
+
+    counts = {'converted': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0}
+    tasks = []
+    for task in find_tasks(inputs, output_dir, include_xarc):
+        task.compact = compact
+        entry = entries.get(task.source_id, None)
+        if entry is not None and entry['output'] != task.output:
+            entry = None
+        # JSON written in the other mode is out of date whatever its age
+        mode_changed = task.to_json and entry is not None and entry.get('compact', False) != compact
+        if not force and not mode_changed:
+            if is_up_to_date(task):
+                counts['skipped'] += 1
+                continue
+            if entry is not None:
+                task.previous_hash = entry['hash']
+        tasks.append(task)
+
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count(), _init_worker)
+    done = set()
+    try:
+        pending = 0
+        # chunks of one task, with larger chunks imap_unordered returns a generator without a timeout
+        results = pool.imap_unordered(convert, tasks)
+        while True:
+            try:
+                task, status, digest, size, error = results.next(_RESULT_TIMEOUT)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+
+            done.add(task.source_id)
+            counts[status] += 1
+            if status == 'failed':
+                print >> sys.stderr, "{0}: {1}".format(task.source_id, error)
+                continue
+            if verbose:
+                print "{0}: {1}".format(task.source_id, status)
+
+            entries[task.source_id] = {'hash': digest, 'output': task.output, 'compact': task.compact}
+            pending += 1
+            if pending >= _MANIFEST_SAVE_INTERVAL:
+                save_manifest(manifest, entries)
+                pending = 0
+    except KeyboardInterrupt:
+        save_manifest(manifest, entries)
+        pool.terminate()
+        pool.join()
+        _remove_partial_outputs(task for task in tasks if task.source_id not in done)
+        raise
+    pool.close()
+    pool.join()
+    save_manifest(manifest, entries)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert .ani and .cir files between the binary format and JSON')
+    parser.add_argument('inputs', nargs='+', help='Files and directories to convert. Binary files are converted to <name>.json, <name>.json files to binary')
+    parser.add_argument('-o', dest='output', required=True, help='Output root directory')
+    parser.add_argument('-j', dest='jobs', type=int, default=multiprocessing.cpu_count(), help='Number of worker processes. Defaults to the number of CPUs')
+    parser.add_argument('--xarc', action='store_true', help='Also convert the members of .xarc archives, to a directory named after each archive')
+    parser.add_argument('--manifest', help='Manifest path, defaults to {0} in the output directory'.format(MANIFEST_NAME))
+    parser.add_argument('--force', action='store_true', help='Convert files even if their output is up to date')
+    parser.add_argument('--compact', action='store_true', help='Write JSON without whitespace and with the shortest floats that load back exactly')
+    parser.add_argument('-v', dest='verbose', action='store_true', help='Print every converted file')
+
+    args = parser.parse_args()
+
+    start = time.time()
+    counts = convert_all(args.inputs, args.output, max(1, args.jobs), args.xarc, args.manifest, args.force, args.verbose, args.compact)
+    print "{0} converted, {1} unchanged, {2} up to date, {3} failed in {4:.2f} s".format(
+        counts['converted'], counts['unchanged'], counts['skipped'], counts['failed'], time.time() - start)
+    if counts['failed']:
+        sys.exit(1)
@@ -23,22 +23,427 @@ freely, subject to the following restrictions:
 '''
 
 from collections import OrderedDict
+import functools
+import itertools
+import gc
 import json
+import keyword
+import mmap
 import struct
 import os
+import re
+import sys
+from cStringIO import StringIO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STORAGE_DICT = 'dict'  # records are OrderedDicts, matching the JSON representation
+STORAGE_ARRAY = 'array'  # large blocks of fixed size records are numpy arrays viewing the source data
+STORAGE_RECORD = 'record'  # records are compact Record instances
 
 
 class DataParserException(Exception):
     pass
 
 
+def pause_gc(func):
+    """
+    Decorator disabling the cyclic garbage collector while func runs. Decoding creates large numbers of
+    containers and none of them are garbage, so collections triggered by the allocations are wasted work.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if enabled:
+                gc.enable()
+    return wrapper
+
+
+class Record(object):
+    """
+    Base class for the compact record types created by record_type.
+    Records store their fields in __slots__ and behave like an ordered mapping of them,
+    so code written against OrderedDict records works with them as well.
+    Fields are accessed by key, a field named like one of the mapping methods is stored in a
+    slot with a trailing underscore so that the method keeps working.
+    """
+    __slots__ = ()
+    _fields = ()
+    _slots = {}  # field name -> slot name
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._slots[key])
+        except (KeyError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            slot = self._slots[key]
+        except (KeyError, TypeError):
+            raise KeyError(key)
+        setattr(self, slot, value)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None  # mutable and equal by value, like the OrderedDicts records stand in for
+
+    def __reduce__(self):
+        # pickled as a constructor call, much smaller and faster to load than the default for __slots__ classes
+        return type(self), tuple(self.values())
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, ", ".join("{0}={1!r}".format(k, v) for k, v in self.iteritems()))
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    def items(self):
+        return zip(self._fields, self.values())
+
+    def iterkeys(self):
+        return iter(self._fields)
+
+    def itervalues(self):
+        return (getattr(self, slot) for slot in self.__slots__)
+
+    def iteritems(self):
+        return itertools.izip(self._fields, self.itervalues())
+
+
+def record_type(name, fields):
+    """
+    Creates a Record subclass with the given fields, in order. Instances are created with
+    positional or keyword arguments in field order and take far less memory than an OrderedDict.
+    :param name: the class name
+    :param fields: a sequence of field names, which may not start with an underscore
+    """
+    fields = tuple(fields)
+    reserved = set(k for k in dir(Record) if not k.startswith('_')) | {'new_dict'}
+    slots = tuple(field + '_' if field in reserved else field for field in fields)
+    for field in fields:
+        if field.startswith('_') or not re.match(r'[A-Za-z_][A-Za-z0-9_]*$', field) or keyword.iskeyword(field):
+            raise DataParserException("Invalid field name for record type {0}: '{1}'".format(name, field))
+    if len(set(slots)) != len(slots):
+        raise DataParserException("Field names of record type {0} collide: {1}".format(name, ", ".join(fields)))
+
+    args = ", ".join(fields)
+    namespace = {'OrderedDict': OrderedDict}
+    init_body = "".join("    self.{0} = {1}\n".format(slot, field) for slot, field in zip(slots, fields)) or "    pass\n"
+    exec("def __init__(self, {0}):\n{1}".format(args, init_body), namespace)
+    # builds the equivalent OrderedDict, for parsers using dict storage
+    dict_body = "".join("    d['{0}'] = {0}\n".format(field) for field in fields)
+    exec("def new_dict({0}):\n    d = OrderedDict()\n{1}    return d\n".format(args, dict_body), namespace)
+
+    cls = type(name, (Record,), {'__slots__': slots, '_fields': fields, '_slots': dict(zip(fields, slots)),
+                                 '__init__': namespace['__init__'], 'new_dict': staticmethod(namespace['new_dict'])})
+    cls.__module__ = sys._getframe(1).f_globals.get('__name__', '__main__')  # lets records be pickled
+    return cls
+
+
+class LazySequence(object):
+    """
+    A read-only sequence of items decoded from byte ranges of the source data on first access.
+    Items that were never decoded are packed by copying their bytes verbatim.
+    """
+
+    def __init__(self, data, ranges, decode):
+        """
+        :param data: the source data
+        :param ranges: a list of (start, end) byte ranges, one per item
+        :param decode: a callable decoding an item given the source data and its start offset
+        """
+        self._data = data
+        self._ranges = ranges
+        self._decode = decode
+        self._items = [None] * len(ranges)
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+
+        item = self._items[index]
+        if item is None:
+            item = self._items[index] = self._decode(self._data, self._ranges[index][0])
+        return item
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def get_range(self, index):
+        """
+        Returns the (start, end) byte range of an item in the source data
+        """
+        return self._ranges[index]
+
+    def is_decoded(self, index):
+        return self._items[index] is not None
+
+    def iter_decoded(self):
+        """
+        Iterates over the items that have been decoded, without decoding any others
+        """
+        return (item for item in self._items if item is not None)
+
+    def release(self, index):
+        """
+        Drops a decoded item, it is decoded again on next access. Changes made to it are lost.
+        """
+        self._items[index] = None
+
+    def iter_packable(self):
+        """
+        Yields (raw bytes, None) for items that were never decoded and (None, item) for decoded items
+        """
+        for (start, end), item in zip(self._ranges, self._items):
+            if item is None:
+                yield self._data[start:end], None
+            else:
+                yield None, item
+
+
+_structs = {}
+_RECORDS_PER_CALL = 1024
+_PACK_CHUNK_SIZE = 1024 * 1024
+_VERIFY_SIZE = 64 * 1024  # clean sections up to this size are encoded and compared to the loaded data before copying
+
+
+def get_struct(fmt):
+    """
+    Returns a cached struct.Struct for a format string
+    """
+    s = _structs.get(fmt, None)
+    if s is None:
+        s = _structs[fmt] = struct.Struct(fmt)
+    return s
+
+
+def _chunk_struct(fmt, count):
+    """
+    Returns a struct for count records. Only the struct for full chunks is cached, caching the remainders
+    would keep a large struct alive for every distinct record count.
+    """
+    if count == _RECORDS_PER_CALL:
+        return get_struct('<' + fmt * count)
+    return struct.Struct('<' + fmt * count)
+
+
+def unpack_records(data, offset, fmt, count):
+    """
+    Unpacks count consecutive records of the same layout, many records per struct call
+    :param data: the data to read, a string, buffer or mmap
+    :param offset: the offset of the first record
+    :param fmt: a little endian struct format string for one record, without the byte order character
+    :param count: the number of records to read
+    :return: a list of tuples
+    """
+    if count <= 0:
+        return []
+
+    fields = len(get_struct('<' + fmt).unpack_from(data, offset))
+    records = []
+    while count > 0:
+        chunk = min(count, _RECORDS_PER_CALL)
+        chunk_struct = _chunk_struct(fmt, chunk)
+        values = chunk_struct.unpack_from(data, offset)
+        records.extend(zip(*[iter(values)] * fields))
+        offset += chunk_struct.size
+        count -= chunk
+    return records
+
+
+def pack_records(values, fmt, count):
+    """
+    Packs count consecutive records of the same layout, many records per struct call
+    :param values: an iterable of the flattened field values of all records
+    :param fmt: a little endian struct format string for one record, without the byte order character
+    :param count: the number of records
+    :return: a string
+    """
+    values = iter(values)
+    record_struct = get_struct('<' + fmt)
+    fields = len(record_struct.unpack('\0' * record_struct.size))
+    chunks = []
+    while count > 0:
+        chunk = min(count, _RECORDS_PER_CALL)
+        chunk_struct = _chunk_struct(fmt, chunk)
+        chunks.append(chunk_struct.pack(*itertools.islice(values, chunk * fields)))
+        count -= chunk
+    return "".join(chunks)
+
+
+_FLOAT32 = struct.Struct('<f')
+_encode_json_string = json.encoder.encode_basestring_ascii
+
+
+def format_float32(value):
+    """
+    Returns the shortest JSON representation of a float that converts back to the same 32 bit float
+    """
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if numpy is not None:
+        return repr(numpy.float32(value))
+
+    single, = _FLOAT32.unpack(_FLOAT32.pack(value))
+    for precision in (6, 7, 8):
+        text = '{0:.{1}g}'.format(single, precision)
+        if _FLOAT32.unpack(_FLOAT32.pack(float(text)))[0] == single:
+            break
+    else:
+        text = '{0:.9g}'.format(single)
+    if '.' not in text and 'e' not in text:
+        text += '.0'  # stays a float when loaded
+    return text
+
+
+class _ChunkWriter(object):
+    """
+    Collects small pieces of data and writes them to a file in chunks of about chunk_size bytes
+    """
+
+    def __init__(self, fileobj, chunk_size=_PACK_CHUNK_SIZE):
+        self._write = fileobj.write
+        self._chunk_size = chunk_size
+        self._pieces = []
+        self._size = 0
+
+    def append(self, data):
+        self._pieces.append(data)
+        self._size += len(data)
+        if self._size >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._pieces:
+            self._write("".join(self._pieces))
+            self._pieces = []
+            self._size = 0
+
+
 class DataParser(object):
 
-    def __init__(self):
+    storage_modes = (STORAGE_DICT,)
+    record_types = ()  # the Record types used by the parser, looked up by their fields when loading JSON
+    maps_files = False  # if True, files are memory mapped rather than read, for parsers that decode data on demand
+    schema = None  # the schema.Schema describing the binary layout, if any
+    file_id = None  # the id every file of the binary format starts with, see assets.register_parser
+    parser_version = 1  # increase when the loaded representation of the data changes, invalidates assetcache entries
+
+    def __init__(self, storage=STORAGE_DICT, track_changes=False):
+        """
+        :param storage: how loaded data is represented, one of storage_modes
+        :param track_changes: if True, sections of loaded binary data that are not marked dirty with mark_dirty are
+                              copied verbatim from the loaded data when packing, instead of being encoded, unless
+                              is_dirty detects that they were modified
+        """
+        if storage not in self.storage_modes:
+            raise DataParserException("Unsupported storage mode '{0}', expected one of: {1}".format(storage, ", ".join(self.storage_modes)))
+        if storage == STORAGE_ARRAY and numpy is None:
+            raise DataParserException("Array storage requires numpy")
+
+        self.storage = storage
+        self.track_changes = track_changes
+        self._record_types_by_fields = dict((record_class._fields, record_class) for record_class in self.record_types)
         self.clear()
 
     def __str__(self):
-        return json.dumps(self.data, indent=4)
+        return json.dumps(self.data, indent=4, default=self._json_default)
+
+    def dump_json(self, fileobj, compact=False, chunk_size=_PACK_CHUNK_SIZE):
+        """
+        Writes the data as JSON to a file as it is encoded, without building it in memory
+        :param fileobj: a file-like object with a write method
+        :param compact: if False, the output is the same as __str__. If True, it has no whitespace and floats are
+                        written with the fewest digits that load back to the same 32 bit float
+        :param chunk_size: the approximate size of each write
+        """
+        writer = _ChunkWriter(fileobj, chunk_size)
+        if compact:
+            self._write_compact_json(self.data, writer.append)
+        else:
+            for chunk in json.JSONEncoder(indent=4, default=self._json_default).iterencode(self.data):
+                writer.append(chunk)
+        writer.flush()
+
+    def _write_compact_json(self, item, append):
+        if isinstance(item, float):
+            append(format_float32(item))
+        elif isinstance(item, basestring):
+            append(_encode_json_string(item))
+        elif isinstance(item, (OrderedDict, Record, dict)):
+            append('{')
+            first = True
+            for key, value in item.iteritems():
+                if first:
+                    first = False
+                else:
+                    append(',')
+                append(_encode_json_string(key))
+                append(':')
+                self._write_compact_json(value, append)
+            append('}')
+        elif isinstance(item, (list, tuple, LazySequence)):
+            append('[')
+            first = True
+            for value in item:
+                if first:
+                    first = False
+                else:
+                    append(',')
+                self._write_compact_json(value, append)
+            append(']')
+        elif item is True:
+            append('true')
+        elif item is False:
+            append('false')
+        elif item is None:
+            append('null')
+        elif isinstance(item, (int, long)):
+            append(str(item))
+        else:
+            self._write_compact_json(self._json_default(item), append)
+
+    def _json_default(self, item):
+        """
+        Converts items json can not serialize, such as numpy arrays, to lists and dicts
+        """
+        if isinstance(item, Record):
+            return OrderedDict(item.iteritems())
+        if isinstance(item, LazySequence):
+            return list(item)
+        if numpy is not None and isinstance(item, numpy.ndarray):
+            return item.tolist()
+        raise TypeError("{0} is not JSON serializable".format(repr(item)))
 
     def load_data(self, data):
         """
@@ -52,39 +457,187 @@ class DataParser(object):
         """
         raise DataParserException('Not implemented!')
 
+    def _record_factory(self, record_class):
+        """
+        Returns a callable creating a record of the given type in the parser's storage mode
+        from positional values in field order
+        """
+        if self.storage == STORAGE_RECORD:
+            return record_class
+        return record_class.new_dict
+
+    def _object_pairs_hook(self, pairs):
+        if self.storage == STORAGE_RECORD:
+            record_class = self._record_types_by_fields.get(tuple(k for k, _ in pairs), None)
+            if record_class is not None:
+                return record_class(*[v for _, v in pairs])
+        return OrderedDict(pairs)
+
     def clear(self):
         self.data = OrderedDict()
+        self.sections = OrderedDict()  # schema section name -> (start, end) byte range in the loaded binary data
+        self._source = None  # the loaded binary data, kept when tracking changes
+        self._dirty = set()
+        self._snapshots = {}  # section name -> the _snapshot of a large section when it was loaded, when tracking changes
 
-    def load(self, data):
+    def _decode_section(self, decoder, section, data, offset):
         """
-        Loads data
-        :param data: Data to load, can be a file path, raw data, or a string on the same format as returned by __str__
+        Decodes a schema section into data and records its byte range
+        :return: the offset following the section
         """
+        end = decoder.decode_section(section, data, offset, self.data)
+        self._loaded_section(section, offset, end)
+        return end
 
-        try:
-            if os.path.exists(data):
-                with open(data, 'rb') as f:
-                    raw_data = f.read()
-                    self.load_data(raw_data)
-                    return
-        except TypeError:
-            # not a file path
-            pass
+    def _loaded_section(self, section, start, end):
+        """
+        Records the byte range of a loaded section, and a snapshot of it if it is too large to be verified by encoding
+        """
+        self.sections[section] = (start, end)
+        if self._source is not None and end - start > _VERIFY_SIZE:
+            self._snapshots[section] = self._snapshot(section)
+
+    def _snapshot(self, section):
+        """
+        Returns the top level values of a section, with containers replaced by their identity and length
+        """
+        snapshot = []
+        for name in self.schema.field_names[section]:
+            value = self.data.get(name, None)
+            if isinstance(value, (list, LazySequence)) or (numpy is not None and isinstance(value, numpy.ndarray)):
+                value = (id(value), len(value))
+            elif isinstance(value, (dict, Record)):
+                value = id(value)
+            snapshot.append(value)
+        return snapshot
+
+    def _is_modified(self, section):
+        """
+        Returns True if a loaded section was found to be modified. Small sections are encoded and compared to the
+        loaded data, large sections are compared to their snapshot, which misses changes made inside their items.
+        """
+        if section in self._snapshots:
+            return self._snapshot(section) != self._snapshots[section]
 
+        start, end = self.sections[section]
+        out = []
         try:
-            self.data = json.loads(data, object_pairs_hook=OrderedDict)
-            self.normalize_data()
+            self.schema.compile(self.storage).encode_section(section, self.data, out)
+        except Exception:
+            return True  # data that no longer encodes has certainly been modified
+        return "".join(out) != self._source[start:end]
+
+    def _track_source(self, data):
+        """
+        Keeps the loaded binary data for copying unmodified sections when packing, if tracking changes
+        """
+        if self.track_changes:
+            self._source = data
+
+    def mark_dirty(self, *sections):
+        """
+        Marks schema sections as modified, so that they are encoded rather than copied from the loaded data when
+        packing. Sections holding the counts of a dirty section are marked as well.
+        :param sections: the names of the modified sections, all sections if none are given
+        """
+        if self.schema is None:
             return
-        except ValueError:
-            # not a string representation, raw data?
-            pass
 
+        if not sections:
+            sections = self.schema.sections.keys()
+        for section in sections:
+            if section not in self.schema.sections:
+                raise DataParserException("Unknown section '{0}', expected one of: {1}".format(section, ", ".join(self.schema.sections)))
+            self._dirty.add(section)
+            self._dirty.update(self.schema.dependencies[section])
+
+    def is_dirty(self, section):
+        """
+        Returns True if a section has to be encoded when packing, because it was modified or changes are not tracked.
+        Besides sections marked with mark_dirty, sections found to be modified are dirty, along with the sections
+        holding their counts. Small sections are checked completely, for large sections only changes to their top
+        level values are found, such as a replaced array or items added to or removed from it. Changes made inside
+        the items of a large section have to be marked with mark_dirty.
+        """
+        if self._source is None or section in self._dirty or section not in self.sections:
+            return True
+        return any(self._is_modified(s) for s in self.sections if s == section or section in self.schema.dependencies[s])
+
+    def load(self, data):
+        """
+        Loads data, prefer load_file, load_bytes or load_json when the kind of data is known
+        :param data: Data to load, can be a file path, raw data, or a string on the same format as returned by __str__
+        """
+        if not isinstance(data, basestring):
+            self.load_bytes(data)  # a buffer or mmap
+        elif '\0' in data[:8]:
+            self.load_bytes(data)  # every binary format starts with a small id, paths and JSON never contain NUL
+        elif data.lstrip()[:1] == '{':
+            self.load_json(data)
+        elif os.path.exists(data):
+            self.load_file(data)
+        else:
+            self.load_bytes(data)
+
+    def load_file(self, filename):
+        """
+        Loads binary data from a file, memory mapping it if the parser maps files
+        """
+        with open(filename, 'rb') as f:
+            if self.maps_files and os.fstat(f.fileno()).st_size > 0:
+                raw_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                raw_data = f.read()
+        self.load_bytes(raw_data)
+
+    def load_bytes(self, data):
+        """
+        Loads binary data
+        :param data: a string, buffer or mmap
+        """
         self.load_data(data)
 
+    def load_json(self, text):
+        """
+        Loads a string on the same format as returned by __str__
+        """
+        if self.schema is not None:
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            self.load_json_file(StringIO(text))
+            return
+
+        parsed = json.loads(text, object_pairs_hook=self._object_pairs_hook)
+        self.clear()
+        self.data = parsed
+        self.normalize_data()
+
+    @pause_gc
+    def load_json_file(self, fileobj):
+        """
+        Loads JSON on the same format as returned by __str__ from a file. With a schema, the document is streamed:
+        arrays are converted to the storage mode as they are read and counts are computed along the way, so the
+        document as a whole is never held in memory.
+        :param fileobj: a file-like object with a read method
+        """
+        if self.schema is None:
+            self.load_json(fileobj.read())
+            return
+
+        from jsonreader import read_json  # jsonreader depends on this module
+        parsed = read_json(fileobj, self.schema, self.storage, self._record_factory)
+        self.clear()
+        self.data = parsed
+
     def pack(self):
         """
         Returns a binary representation of the data
         """
+        if self.schema is not None:
+            out = []
+            self._encode_to(out)
+            return "".join(out)
+
         fmt = ["<"]
         datalist = []
 
@@ -98,12 +651,22 @@ class DataParser(object):
             elif isinstance(item, (str, unicode)):  # manipulating data can change it to unicode...
                 datalist.append(item.encode("iso-8859-1"))
                 fmt.append("{0}s".format(len(item)))
-            elif isinstance(item, list):
+            elif isinstance(item, (list, tuple)):
                 for v in item:
                     _pack_item(v)
-            elif isinstance(item, OrderedDict):
+            elif isinstance(item, (OrderedDict, Record)):
                 for v in item.itervalues():
                     _pack_item(v)
+            elif isinstance(item, LazySequence):
+                for raw, v in item.iter_packable():
+                    if raw is not None:
+                        datalist.append(raw)
+                        fmt.append("{0}s".format(len(raw)))
+                    else:
+                        _pack_item(v)
+            elif numpy is not None and isinstance(item, numpy.ndarray):  # arrays are stored in their on-disk layout
+                datalist.append(item.tobytes())
+                fmt.append("{0}s".format(item.nbytes))
             else:
                 raise DataParserException("Encountered unknown type '{0}' while packing item: {1}".format(type(item), item))
 
@@ -111,3 +674,31 @@ class DataParser(object):
             _pack_item(v)
 
         return struct.pack("".join(fmt), *datalist)
+
+    def pack_to(self, fileobj, chunk_size=_PACK_CHUNK_SIZE):
+        """
+        Writes a binary representation of the data to a file as it is encoded, without building it in memory.
+        Parsers without a schema fall back to writing the result of pack.
+        :param fileobj: a file-like object with a write method
+        :param chunk_size: the approximate size of each write
+        """
+        if self.schema is None:
+            fileobj.write(self.pack())
+            return
+
+        writer = _ChunkWriter(fileobj, chunk_size)
+        self._encode_to(writer)
+        writer.flush()
+
+    def _encode_to(self, out):
+        """
+        Passes the encoded data to out.append in pieces, copying clean sections from the loaded data
+        """
+        encoder = self.schema.compile(self.storage)
+        for section in self.schema.sections:
+            if self.is_dirty(section):
+                encoder.encode_section(section, self.data, out)
+            else:
+                start, end = self.sections[section]
+                for chunk_start in xrange(start, end, _PACK_CHUNK_SIZE):
+                    out.append(self._source[chunk_start:min(end, chunk_start + _PACK_CHUNK_SIZE)])
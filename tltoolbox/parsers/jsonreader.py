@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+# Streaming reader for JSON written by DataParser.__str__ and DataParser.dump_json, driven by a parser's schema.
+# The document is read in chunks and never materialized as a whole. Elements of arrays are decoded one at a time
+# with the json module's C scanner and converted to the storage mode right away, fixed size records are packed
+# into numpy arrays with array storage. Counts and lengths are recomputed from the arrays and strings they describe
+# as each record is completed.
+
+import json
+import re
+from collections import OrderedDict
+
+from dataparser import numpy, pack_records, STORAGE_ARRAY, STORAGE_RECORD, _RECORDS_PER_CALL
+from schema import Array, Field, SchemaException, String, Struct, Switch, _fixed_fmt, _fmt_values, _is_fixed
+
+_CHUNK_SIZE = 64 * 1024
+_MAX_VALUE_SIZE = 16 * 1024 * 1024  # larger values are not expected below the level of array elements
+_LOOKAHEAD = 64  # longer than any number
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _Stream(object):
+    """
+    A window on a file of JSON text, refilled as values are consumed
+    """
+
+    def __init__(self, fileobj, chunk_size=_CHUNK_SIZE):
+        self._read = fileobj.read
+        self._chunk_size = chunk_size
+        self._decode = json.JSONDecoder().raw_decode
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        data = self._read(self._chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, or '' at the end of the file
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, c):
+        found = self.peek()
+        if found != c:
+            raise ValueError("Expected '{0}' at offset {1} of the buffer, found '{2}'".format(c, self.pos, found))
+        self.pos += 1
+
+    def skip(self, c):
+        """
+        Consumes the next character if it is c
+        :return: True if it was c
+        """
+        if self.peek() == c:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        """
+        Decodes a complete value with the C scanner, reading more data until it is complete
+        """
+        self.peek()
+        while len(self.buf) - self.pos < _LOOKAHEAD and self._fill():
+            pass  # a number is only known to be complete if it is followed by something else
+        while True:
+            try:
+                value, end = self._decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if len(self.buf) - self.pos > _MAX_VALUE_SIZE or not self._fill():
+                    raise
+                continue
+            self._fill()
+
+
+def _flattener(item):
+    """
+    Returns a function returning the leaf values of a decoded JSON value, in the order of the fixed size item
+    """
+    if isinstance(item, basestring):
+        if _fmt_values(item) == 1:
+            return lambda value: (value,)
+        return tuple
+
+    def flatten(value, leaves, field):
+        if isinstance(field, Field):
+            leaves.append(value)
+        else:
+            for f in field.fields:
+                flatten(value[f.name], leaves, f)
+
+    def flatten_item(value):
+        leaves = []
+        flatten(value, leaves, item)
+        return leaves
+    return flatten_item
+
+
+class _Reader(object):
+    def __init__(self, schema, storage, record_factory):
+        self.storage = storage
+        self.record_factory = record_factory
+        self.new_tuple = tuple if storage == STORAGE_RECORD else list
+        self._builders = {}
+
+    def builder(self, item):
+        """
+        Returns a function converting a decoded JSON object to a fixed size record of the storage mode
+        """
+        builder = self._builders.get(id(item), None)
+        if builder is not None:
+            return builder
+
+        factory = self.record_factory(item.record_class)
+        parts = []
+        for field in item.fields:
+            if isinstance(field, Struct):
+                parts.append((field.name, self.builder(field)))
+            else:
+                parts.append((field.name, None))
+
+        def build(value):
+            return factory(*[value[name] if sub is None else sub(value[name]) for name, sub in parts])
+
+        self._builders[id(item)] = build
+        return build
+
+    def read_array(self, stream, field):
+        item = field.item
+        stream.expect('[')
+        if self.storage == STORAGE_ARRAY and field.dtype is not None:
+            return self.read_packed_array(stream, field)
+        if stream.skip(']'):
+            items = []
+        elif isinstance(item, Struct) and not _is_fixed(item):
+            items = []
+            while True:
+                items.append(self.read_struct(stream, item))
+                if not stream.skip(','):
+                    break
+            stream.expect(']')
+        else:
+            if isinstance(item, Struct):
+                convert = self.builder(item)
+            elif _fmt_values(item) > 1:
+                convert = self.new_tuple
+            else:
+                convert = None
+            items = []
+            while True:
+                value = stream.value()
+                items.append(value if convert is None else convert(value))
+                if not stream.skip(','):
+                    break
+            stream.expect(']')
+        return items
+
+    def read_packed_array(self, stream, field):
+        """
+        Reads the rest of an array of fixed size items into a numpy array, packing them as they are read
+        """
+        item = field.item
+        fmt = item if isinstance(item, basestring) else _fixed_fmt(item)
+        flatten = _flattener(item)
+        chunks = []
+        leaves = []
+        count = 0
+        while not stream.skip(']'):
+            leaves.extend(flatten(stream.value()))
+            count += 1
+            if count % _RECORDS_PER_CALL == 0:
+                chunks.append(pack_records(leaves, fmt, _RECORDS_PER_CALL))
+                leaves = []
+            if not stream.skip(','):
+                stream.expect(']')
+                break
+        if leaves:
+            chunks.append(pack_records(leaves, fmt, count % _RECORDS_PER_CALL))
+
+        values = _fmt_values(fmt)
+        array = numpy.frombuffer("".join(chunks), field.dtype)
+        if isinstance(item, basestring) and values > 1:
+            array = array.reshape(-1, values)
+        return array
+
+    def read_field(self, stream, field):
+        if isinstance(field, (Field, String)):
+            return stream.value()
+        if isinstance(field, Array):
+            return self.read_array(stream, field)
+        if isinstance(field, Struct):
+            return self.builder(field)(stream.value()) if _is_fixed(field) else self.read_struct(stream, field)
+        raise SchemaException("Unsupported field type '{0}'".format(type(field).__name__))
+
+    def read_object(self, stream, fields, values):
+        """
+        Reads the members of an object into values, using fields to decode them
+        """
+        stream.expect('{')
+        if stream.skip('}'):
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            field = fields.get(key, None)
+            if field is None:
+                raise SchemaException("Unexpected field '{0}'".format(key))
+            values[key] = self.read_field(stream, field)
+            if not stream.skip(','):
+                break
+        stream.expect('}')
+
+    def read_struct(self, stream, item):
+        values = {}
+        self.read_object(stream, dict((f.name, f) for f in item.fields), values)
+        _update_sizes(item.fields, values)
+        try:
+            return self.record_factory(item.record_class)(*[values[f.name] for f in item.fields])
+        except KeyError as e:
+            raise SchemaException("Missing field '{0}' in {1}".format(e.args[0], item.record_class.__name__))
+
+    def read_root(self, stream, schema):
+        fields = {}
+        for section_fields in schema.sections.itervalues():
+            _collect_fields(section_fields, fields)
+        root = OrderedDict()
+        self.read_object(stream, fields, root)
+        for section_fields in schema.sections.itervalues():
+            _update_sizes(section_fields, root)
+        if stream.peek() != '':
+            raise ValueError("Extra data after the JSON document")
+        return root
+
+
+def _collect_fields(fields, result):
+    for field in fields:
+        if isinstance(field, Switch):
+            for case_fields in field.cases.itervalues():
+                _collect_fields(case_fields, result)
+        else:
+            result[field.name] = field
+
+
+def _update_sizes(fields, values):
+    """
+    Sets the count and length fields of the arrays and strings in values
+    """
+    for field in fields:
+        if isinstance(field, Switch):
+            for case_fields in field.cases.itervalues():
+                _update_sizes(case_fields, values)
+        elif isinstance(field, Array) and field.name in values:
+            values[field.count_field] = len(values[field.name])
+        elif isinstance(field, String) and field.name in values:
+            values[field.length_field] = len(values[field.name])
+
+
+def read_json(fileobj, schema, storage, record_factory):
+    """
+    Reads a JSON document on the format of DataParser.__str__ from a file
+    :param schema: the schema.Schema of the data
+    :param storage: the storage mode of the result
+    :param record_factory: returns the constructor of a record class, see DataParser._record_factory
+    :return: the root OrderedDict
+    """
+    return _Reader(schema, storage, record_factory).read_root(_Stream(fileobj), schema)
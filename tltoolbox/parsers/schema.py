@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+# Declarative descriptions of binary layouts, compiled to specialized Python decode, skip and encode functions.
+#
+# A schema is a list of named sections, each a list of fields:
+#   Field(name, fmt)                            a fixed size value, fmt is a struct format character
+#   String(name, length_field)                  a string whose length is stored in an earlier field
+#   Array(name, count_field, item, dtype=None)  count_field items, each a struct format for a scalar or a fixed
+#                                               size tuple ('I', '3I'), or a Struct. With array storage, arrays
+#                                               of fixed size items that have a numpy dtype are decoded with frombuffer
+#   Struct(name, record_class, fields)          a nested record, name is None for array items
+#   Switch(field, cases)                        fields that depend on the value of an earlier field
+# Runs of fixed size fields, including nested fixed size structs, are decoded and encoded with one struct call.
+
+import re
+import struct
+from collections import OrderedDict
+
+from dataparser import (get_struct, numpy, pack_records, unpack_records, LazySequence, STORAGE_ARRAY, STORAGE_RECORD,
+                        _RECORDS_PER_CALL)
+
+
+class SchemaException(Exception):
+    pass
+
+
+class Field(object):
+    def __init__(self, name, fmt):
+        self.name = name
+        self.fmt = fmt
+
+
+class String(object):
+    def __init__(self, name, length_field):
+        self.name = name
+        self.length_field = length_field
+
+
+class Array(object):
+    def __init__(self, name, count_field, item, dtype=None):
+        self.name = name
+        self.count_field = count_field
+        self.item = item
+        self.dtype = dtype
+
+
+class Struct(object):
+    def __init__(self, name, record_class, fields):
+        if tuple(field.name for field in fields) != record_class._fields:
+            raise SchemaException("Fields of struct '{0}' do not match the fields of {1}".format(name, record_class.__name__))
+        self.name = name
+        self.record_class = record_class
+        self.fields = fields
+
+
+class Switch(object):
+    def __init__(self, field, cases):
+        self.name = None
+        self.field = field
+        self.cases = cases
+
+
+def _is_fixed(field):
+    if isinstance(field, Field):
+        return True
+    if isinstance(field, Struct):
+        return all(_is_fixed(f) for f in field.fields)
+    return False
+
+
+def _fixed_fmt(field):
+    if isinstance(field, Field):
+        return field.fmt
+    return "".join(_fixed_fmt(f) for f in field.fields)
+
+
+def _fmt_values(fmt):
+    s = get_struct('<' + fmt)
+    return len(s.unpack('\0' * s.size))
+
+
+def _field_names(fields):
+    """
+    Yields the names of fields, including the fields of all cases of switches
+    """
+    for field in fields:
+        if isinstance(field, Switch):
+            for case_fields in field.cases.itervalues():
+                for name in _field_names(case_fields):
+                    yield name
+        else:
+            yield field.name
+
+
+def _size_field_names(fields):
+    """
+    Yields the names of the fields holding the counts and lengths of arrays and strings in fields
+    """
+    for field in fields:
+        if isinstance(field, Switch):
+            yield field.field
+            for case_fields in field.cases.itervalues():
+                for name in _size_field_names(case_fields):
+                    yield name
+        elif isinstance(field, Array):
+            yield field.count_field
+        elif isinstance(field, String):
+            yield field.length_field
+
+
+def _encode_string(value):
+    if isinstance(value, unicode):  # manipulating data can change it to unicode...
+        return value.encode("iso-8859-1")
+    return value
+
+
+def _encode_fixed_array(out, items, fmt, values_per_item, flatten):
+    """
+    Appends the encoded items to out, in chunks of at most _RECORDS_PER_CALL items
+    """
+    count = len(items)
+    if numpy is not None and isinstance(items, numpy.ndarray):  # arrays are stored in their on-disk layout
+        for start in xrange(0, count, _RECORDS_PER_CALL):
+            out.append(items[start:start + _RECORDS_PER_CALL].tobytes())
+        return
+    if flatten is not None:
+        values = (value for item in items for value in flatten(item))
+    elif values_per_item > 1:
+        values = (value for item in items for value in item)
+    else:
+        values = iter(items)
+    for start in xrange(0, count, _RECORDS_PER_CALL):
+        out.append(pack_records(values, fmt, min(count - start, _RECORDS_PER_CALL)))
+
+
+class _Writer(object):
+    """
+    Collects generated source lines
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.indent = 0
+
+    def __call__(self, line):
+        self.lines.append("    " * self.indent + line)
+
+    def block(self, line):
+        self(line)
+        self.indent += 1
+
+    def end(self):
+        self.indent -= 1
+
+
+class _Compiler(object):
+    def __init__(self, schema, storage):
+        self.storage = storage
+        self.namespace = {
+            'struct': struct,
+            'unpack_records': unpack_records,
+            'frombuffer': numpy.frombuffer if numpy is not None else None,
+            'encode_string': _encode_string,
+            'encode_fixed_array': _encode_fixed_array,
+            'LazySequence': LazySequence,
+            'SchemaException': SchemaException,
+            'new_tuple': tuple if storage == STORAGE_RECORD else list,
+        }
+        self.constants = {}
+        self.counter = 0
+        self.structs = OrderedDict()  # record class -> variable size Struct
+        self.flatteners = OrderedDict()  # record class -> fixed size Struct
+        self.out = _Writer()
+
+        for _, fields in schema.sections.iteritems():
+            self._collect(fields)
+
+    def _collect(self, fields):
+        for field in fields:
+            if isinstance(field, Switch):
+                for case_fields in field.cases.itervalues():
+                    self._collect(case_fields)
+            elif isinstance(field, Array) and isinstance(field.item, Struct):
+                item = field.item
+                if _is_fixed(item):
+                    self.flatteners[item.record_class] = item
+                else:
+                    self.structs[item.record_class] = item
+                self._collect(item.fields)
+            elif isinstance(field, Struct):
+                self._collect(field.fields)
+
+    def const(self, value, prefix):
+        key = (prefix, id(value))
+        name = self.constants.get(key, None)
+        if name is None:
+            name = self.constants[key] = "{0}{1}".format(prefix, len(self.constants))
+            self.namespace[name] = value
+        return name
+
+    def struct_const(self, fmt):
+        return self.const(get_struct('<' + fmt), '_struct')
+
+    def factory(self, record_class):
+        if self.storage == STORAGE_RECORD:
+            return self.const(record_class, '_new')
+        return self.const(record_class.new_dict, '_new')
+
+    def var(self, prefix='v'):
+        self.counter += 1
+        return "{0}{1}".format(prefix, self.counter)
+
+    @staticmethod
+    def ref(name, names, root):
+        if name in names:
+            return names[name]
+        if root:
+            return "root['{0}']".format(name)
+        raise SchemaException("Field '{0}' is referenced before it is defined".format(name))
+
+    # decoding
+
+    def record_expr(self, field, leaves):
+        if isinstance(field, Field):
+            return next(leaves)
+        return "{0}({1})".format(self.factory(field.record_class), ", ".join(self.record_expr(f, leaves) for f in field.fields))
+
+    def decode_fixed(self, run, names, root):
+        out = self.out
+        leaves = [self.var('t') for _ in xrange(_fmt_values("".join(_fixed_fmt(f) for f in run)))]
+        fmt = "".join(_fixed_fmt(f) for f in run)
+        out("{0}, = {1}.unpack_from(data, offset)".format(", ".join(leaves), self.struct_const(fmt)))
+        out("offset += {0}".format(get_struct('<' + fmt).size))
+        leaf_iter = iter(leaves)
+        for field in run:
+            if isinstance(field, Field):
+                v = next(leaf_iter)
+            else:
+                v = self.var()
+                out("{0} = {1}".format(v, self.record_expr(field, leaf_iter)))
+            self.define(field.name, v, names, root)
+
+    def define(self, name, v, names, root):
+        names[name] = v
+        if root:
+            self.out("root['{0}'] = {1}".format(name, v))
+
+    def decode_fields(self, fields, names, root):
+        out = self.out
+        run = []
+        for field in fields + [None]:
+            if field is not None and _is_fixed(field):
+                run.append(field)
+                continue
+            if run:
+                self.decode_fixed(run, names, root)
+                run = []
+            if field is None:
+                break
+
+            if isinstance(field, String):
+                length = self.ref(field.length_field, names, root)
+                v = self.var()
+                out("{0} = data[offset:offset + {1}]".format(v, length))
+                out("if len({0}) != {1}:".format(v, length))
+                out("    raise struct.error('Expected a string of {{0}} bytes at offset {{1}}'.format({0}, offset))".format(length))
+                out("offset += {0}".format(length))
+                self.define(field.name, v, names, root)
+            elif isinstance(field, Array):
+                self.define(field.name, self.decode_array(field, self.ref(field.count_field, names, root)), names, root)
+            elif isinstance(field, Switch):
+                value = self.ref(field.field, names, root)
+                for i, (case, case_fields) in enumerate(sorted(field.cases.iteritems())):
+                    out.block("{0} {1} == {2!r}:".format('if' if i == 0 else 'elif', value, case))
+                    self.decode_fields(case_fields, dict(names), root)
+                    out.end()
+                out.block("else:")
+                out("raise SchemaException('Unexpected value for {0}: {{0}}'.format({1}))".format(field.field, value))
+                out.end()
+            else:
+                raise SchemaException("Unsupported field type '{0}'".format(type(field).__name__))
+
+    def decode_array(self, field, count):
+        out = self.out
+        item = field.item
+        v = self.var()
+        use_dtype = self.storage == STORAGE_ARRAY and field.dtype is not None
+        if isinstance(item, Struct) and not _is_fixed(item):
+            decode = "decode_{0}".format(item.record_class.__name__)
+            out("{0} = []".format(v))
+            out.block("for _ in xrange({0}):".format(count))
+            out("item, offset = {0}(data, offset)".format(decode))
+            out("{0}.append(item)".format(v))
+            out.end()
+            return v
+
+        fmt = item if isinstance(item, basestring) else _fixed_fmt(item)
+        size = get_struct('<' + fmt).size
+        values = _fmt_values(fmt)
+        if use_dtype:
+            dtype = self.const(field.dtype, '_dtype')
+            if isinstance(item, Struct) or values == 1:
+                out("{0} = frombuffer(data, {1}, {2}, offset)".format(v, dtype, count))
+            else:
+                out("{0} = frombuffer(data, {1}, {2} * {3}, offset).reshape(-1, {3})".format(v, dtype, count, values))
+        elif isinstance(item, Struct):
+            leaves = [self.var('t') for _ in xrange(values)]
+            out("{0} = [{1} for ({2},) in unpack_records(data, offset, {3!r}, {4})]".format(
+                v, self.record_expr(item, iter(leaves)), ", ".join(leaves), fmt, count))
+        elif values == 1:
+            out("{0} = list(struct.unpack_from('<{{0}}{1}'.format({2}), data, offset))".format(v, fmt, count))
+        else:
+            out("{0} = [new_tuple(t) for t in unpack_records(data, offset, {1!r}, {2})]".format(v, fmt, count))
+        out("offset += {0} * {1}".format(count, size))
+        return v
+
+    # skipping
+
+    def skip_fields(self, fields, names):
+        out = self.out
+        referenced = set()
+        for field in fields:
+            if isinstance(field, String):
+                referenced.add(field.length_field)
+            elif isinstance(field, Array):
+                referenced.add(field.count_field)
+            elif isinstance(field, Switch):
+                referenced.add(field.field)
+
+        run = []
+        for field in fields + [None]:
+            if field is not None and _is_fixed(field):
+                run.append(field)
+                continue
+            if run:
+                if any(f.name in referenced for f in run):
+                    self.decode_fixed(run, names, False)
+                else:
+                    out("offset += {0}".format(get_struct('<' + "".join(_fixed_fmt(f) for f in run)).size))
+                run = []
+            if field is None:
+                break
+
+            if isinstance(field, String):
+                out("offset += {0}".format(self.ref(field.length_field, names, False)))
+            elif isinstance(field, Array):
+                count = self.ref(field.count_field, names, False)
+                item = field.item
+                if isinstance(item, Struct) and not _is_fixed(item):
+                    out.block("for _ in xrange({0}):".format(count))
+                    out("offset = skip_{0}(data, offset)".format(item.record_class.__name__))
+                    out.end()
+                else:
+                    fmt = item if isinstance(item, basestring) else _fixed_fmt(item)
+                    out("offset += {0} * {1}".format(count, get_struct('<' + fmt).size))
+            else:
+                raise SchemaException("Can not skip field type '{0}'".format(type(field).__name__))
+
+    # encoding
+
+    def leaf_exprs(self, field, expr):
+        """
+        Returns expressions for the leaf values of a fixed size field, given an expression for the field
+        """
+        if isinstance(field, Field):
+            return [expr]
+        if not expr.isalnum():
+            local = self.var('s')
+            self.out("{0} = {1}".format(local, expr))
+            expr = local
+        return [leaf for f in field.fields for leaf in self.leaf_exprs(f, "{0}['{1}']".format(expr, f.name))]
+
+    def encode_fields(self, fields, item):
+        out = self.out
+        run = []
+        for field in fields + [None]:
+            if field is not None and _is_fixed(field):
+                run.append(field)
+                continue
+            if run:
+                leaves = [leaf for f in run for leaf in self.leaf_exprs(f, "{0}['{1}']".format(item, f.name))]
+                out("out.append({0}.pack({1}))".format(self.struct_const("".join(_fixed_fmt(f) for f in run)), ", ".join(leaves)))
+                run = []
+            if field is None:
+                break
+
+            value = "{0}['{1}']".format(item, field.name) if field.name is not None else None
+            if isinstance(field, String):
+                out("out.append(encode_string({0}))".format(value))
+            elif isinstance(field, Array):
+                self.encode_array(field, value)
+            elif isinstance(field, Switch):
+                for i, (case, case_fields) in enumerate(sorted(field.cases.iteritems())):
+                    out.block("{0} {1}['{2}'] == {3!r}:".format('if' if i == 0 else 'elif', item, field.field, case))
+                    self.encode_fields(case_fields, item)
+                    out.end()
+                out.block("else:")
+                out("raise SchemaException('Unexpected value for {0}: {{0}}'.format({1}['{0}']))".format(field.field, item))
+                out.end()
+
+    def encode_array(self, field, value):
+        out = self.out
+        item = field.item
+        v = self.var()
+        out("{0} = {1}".format(v, value))
+        if isinstance(item, Struct) and not _is_fixed(item):
+            encode = "encode_{0}".format(item.record_class.__name__)
+            out.block("if isinstance({0}, LazySequence):".format(v))
+            out.block("for raw, it in {0}.iter_packable():".format(v))
+            out.block("if raw is not None:")
+            out("out.append(raw)")
+            out.end()
+            out.block("else:")
+            out("{0}(it, out)".format(encode))
+            out.end()
+            out.end()
+            out.end()
+            out.block("else:")
+            out.block("for it in {0}:".format(v))
+            out("{0}(it, out)".format(encode))
+            out.end()
+            out.end()
+            return
+
+        if isinstance(item, Struct):
+            fmt = _fixed_fmt(item)
+            flatten = "flatten_{0}".format(item.record_class.__name__)
+        else:
+            fmt = item
+            flatten = "None"
+        out("encode_fixed_array(out, {0}, {1!r}, {2}, {3})".format(v, fmt, _fmt_values(fmt), flatten))
+
+    def function(self, signature):
+        """
+        Starts a generated function, signature is its name and arguments without the closing parenthesis
+        """
+        self.function_start = len(self.out.lines)
+        self.out.block("def {0}):".format(signature))
+
+    def end_function(self):
+        """
+        Ends a generated function, binding the constants and helpers it uses to default arguments for fast local lookups
+        """
+        out = self.out
+        out.end()
+        used = set(re.findall(r'[A-Za-z_]\w*', "\n".join(out.lines[self.function_start + 1:])))
+        defaults = "".join(", {0}={0}".format(name) for name in sorted(used) if name in self.namespace)
+        out.lines[self.function_start] = out.lines[self.function_start][:-2] + defaults + "):"
+
+    def compile(self, schema):
+        out = self.out
+
+        for record_class, item in self.flatteners.iteritems():
+            self.function("flatten_{0}(item".format(record_class.__name__))
+            out("return ({0},)".format(", ".join(self.leaf_exprs(item, 'item'))))
+            self.end_function()
+
+        for record_class, item in self.structs.iteritems():
+            name = record_class.__name__
+            names = OrderedDict()
+            self.function("decode_{0}(data, offset".format(name))
+            self.decode_fields(item.fields, names, False)
+            out("return {0}({1}), offset".format(self.factory(record_class), ", ".join(names[f.name] for f in item.fields)))
+            self.end_function()
+
+            self.function("skip_{0}(data, offset".format(name))
+            self.skip_fields(item.fields, {})
+            out("return offset")
+            self.end_function()
+
+            self.function("encode_{0}(item, out".format(name))
+            self.encode_fields(item.fields, 'item')
+            self.end_function()
+
+        for section, fields in schema.sections.iteritems():
+            self.function("decode_section_{0}(data, offset, root".format(section))
+            self.decode_fields(fields, {}, True)
+            out("return offset")
+            self.end_function()
+
+            self.function("encode_section_{0}(root, out".format(section))
+            self.encode_fields(fields, 'root')
+            out("pass")
+            self.end_function()
+
+        source = "\n".join(out.lines) + "\n"
+        exec(compile(source, "<schema>", "exec"), self.namespace)
+        return CompiledSchema(schema, self.namespace, source)
+
+
+class CompiledSchema(object):
+    """
+    The decode, skip and encode functions generated for a schema and storage mode
+    """
+
+    def __init__(self, schema, namespace, source):
+        self.schema = schema
+        self.source = source  # the generated code, for debugging
+        self._namespace = namespace
+
+    def decode_section(self, section, data, offset, root):
+        """
+        Decodes a section into root
+        :return: the offset following the section
+        """
+        return self._namespace['decode_section_' + section](data, offset, root)
+
+    def decode_sections(self, data, offset, root):
+        for section in self.schema.sections:
+            offset = self.decode_section(section, data, offset, root)
+        return offset
+
+    def decoder(self, record_class):
+        """
+        Returns a function decoding a record given the data and an offset, returning the record and the following offset
+        """
+        return self._namespace['decode_' + record_class.__name__]
+
+    def skipper(self, record_class):
+        """
+        Returns a function returning the offset following a record without decoding it, given the data and its offset
+        """
+        return self._namespace['skip_' + record_class.__name__]
+
+    def encode(self, root):
+        """
+        Encodes all sections of root
+        :return: a string
+        """
+        out = []
+        self.encode_to(root, out)
+        return "".join(out)
+
+    def encode_to(self, root, out):
+        """
+        Encodes all sections of root, passing the encoded data to out.append in pieces as it is produced
+        """
+        for section in self.schema.sections:
+            self.encode_section(section, root, out)
+
+    def encode_section(self, section, root, out):
+        """
+        Encodes a section of root, passing the encoded data to out.append in pieces as it is produced
+        """
+        self._namespace['encode_section_' + section](root, out)
+
+
+class Schema(object):
+    def __init__(self, sections):
+        """
+        :param sections: a list of (section name, list of fields) tuples in file order
+        """
+        self.sections = OrderedDict(sections)
+        self._compiled = {}
+
+        # section name -> the names of its top level fields
+        self.field_names = dict((section, list(_field_names(fields))) for section, fields in self.sections.iteritems())
+
+        # section name -> the other sections defining the counts and lengths of its top level arrays and strings
+        defined = {}
+        for section, names in self.field_names.iteritems():
+            for name in names:
+                defined[name] = section
+        self.dependencies = {}
+        for section, fields in self.sections.iteritems():
+            self.dependencies[section] = set(defined[name] for name in _size_field_names(fields)
+                                             if name in defined and defined[name] != section)
+
+    def compile(self, storage):
+        """
+        Returns the CompiledSchema for a storage mode, compiling it on first use
+        """
+        compiled = self._compiled.get(storage, None)
+        if compiled is None:
+            compiled = self._compiled[storage] = _Compiler(self, storage).compile(self)
+        return compiled
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+import os
+import sqlite3
+
+from xarcparser import Xarc
+
+
+class XarcCatalog(object):
+    """
+    A persistent index of the files in all .xarc archives below one or more directories.
+    Looking a file up is a single index query, reading it a single positioned read from its archive.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: the path to the catalog database, created if it does not exist
+        """
+        self._db = sqlite3.connect(filename)
+        self._db.text_factory = str
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS archives (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT NOT NULL,
+                archive INTEGER NOT NULL REFERENCES archives(id),
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_name ON files (name);
+            CREATE INDEX IF NOT EXISTS files_archive ON files (archive);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _scan_archive(self, path, st):
+        with Xarc() as xarc:
+            xarc.open(path)
+            files = [(name, xarc.get_file_offset(name), xarc.get_file_size(name)) for name in xarc.get_file_names()]
+
+        cursor = self._db.cursor()
+        cursor.execute("INSERT INTO archives (path, mtime, size) VALUES (?, ?, ?)", (path, st.st_mtime, st.st_size))
+        archive_id = cursor.lastrowid
+        cursor.executemany("INSERT INTO files (name, archive, offset, size) VALUES (?, ?, ?, ?)",
+                           ((name, archive_id, offset, size) for name, offset, size in files))
+
+    def _remove_archive(self, archive_id):
+        self._db.execute("DELETE FROM files WHERE archive = ?", (archive_id,))
+        self._db.execute("DELETE FROM archives WHERE id = ?", (archive_id,))
+
+    def update(self, root):
+        """
+        Scans a directory tree for .xarc archives. Archives whose modification time and size are
+        unchanged since the last scan are skipped, changed archives are rescanned and archives that
+        no longer exist are removed from the catalog.
+        :param root: the directory to scan
+        :return: a (scanned, removed) tuple with the number of archives that were (re)scanned and removed
+        """
+        root = os.path.abspath(root)
+        known = {}
+        for archive_id, path, mtime, size in self._db.execute("SELECT id, path, mtime, size FROM archives"):
+            if path == root or path.startswith(os.path.join(root, '')):
+                known[path] = (archive_id, mtime, size)
+
+        scanned = 0
+        with self._db:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if not filename.lower().endswith('.xarc'):
+                        continue
+
+                    path = os.path.join(dirpath, filename)
+                    st = os.stat(path)
+                    entry = known.pop(path, None)
+                    if entry is not None:
+                        archive_id, mtime, size = entry
+                        if mtime == st.st_mtime and size == st.st_size:
+                            continue
+                        self._remove_archive(archive_id)
+
+                    self._scan_archive(path, st)
+                    scanned += 1
+
+            for archive_id, _, _ in known.itervalues():
+                self._remove_archive(archive_id)
+
+        return scanned, len(known)
+
+    def get_archive_names(self):
+        return [path for path, in self._db.execute("SELECT path FROM archives ORDER BY path")]
+
+    def find(self, filename):
+        """
+        Returns the locations of all copies of a file
+        :param filename: the name of the file in its archive
+        :return: a list of (archive path, offset, size) tuples
+        """
+        return self._db.execute("SELECT archives.path, files.offset, files.size FROM files "
+                                "JOIN archives ON archives.id = files.archive "
+                                "WHERE files.name = ? ORDER BY archives.path", (filename,)).fetchall()
+
+    def lookup(self, filename):
+        """
+        Returns the location of a file as an (archive path, offset, size) tuple, or None if it is not in the catalog.
+        If several archives contain the file, the first archive by path is used.
+        """
+        locations = self.find(filename)
+        if not locations:
+            return None
+        return locations[0]
+
+    def read(self, filename):
+        """
+        Reads the data of a file, or returns None if it is not in the catalog
+        """
+        location = self.lookup(filename)
+        if location is None:
+            return None
+
+        path, offset, size = location
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+# Finds files with identical data within and across .xarc archives
+#
+# Usage: python xarcdedup.py [-j N] [--json OUTPUT] archive.xarc [archive.xarc ...]
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.pool
+import sys
+
+from xarcparser import Xarc, XarcDataException
+
+
+def hash_archive(filename, algorithm='sha1'):
+    """
+    Hashes the data of every file in an archive straight from the memory mapped archive
+    :return: a list of (archive filename, file name, size, hex digest) tuples
+    """
+    hashes = []
+    with Xarc() as xarc:
+        xarc.open(filename)
+        for name in xarc.get_file_names():
+            digest = hashlib.new(algorithm, xarc.get_data(name)).hexdigest()
+            hashes.append((filename, name, xarc.get_file_size(name), digest))
+    return hashes
+
+
+def _hash_archive_task(args):
+    return hash_archive(*args)
+
+
+def build_dedup_index(filenames, jobs=None, algorithm='sha1'):
+    """
+    Hashes all files in a set of archives in parallel. hashlib releases the GIL while hashing
+    large buffers, so archives are hashed on a thread pool.
+    :param filenames: paths to .xarc archives
+    :param jobs: number of archives to hash in parallel, defaults to the number of CPUs
+    :return: a dict mapping hex digests to lists of (archive filename, file name, size) tuples
+    """
+    index = {}
+    pool = multiprocessing.pool.ThreadPool(jobs or multiprocessing.cpu_count())
+    try:
+        for hashes in pool.imap(_hash_archive_task, [(filename, algorithm) for filename in filenames]):
+            for archive, name, size, digest in hashes:
+                index.setdefault(digest, []).append((archive, name, size))
+    finally:
+        pool.close()
+        pool.join()
+    return index
+
+
+def duplicate_sets(index):
+    """
+    Returns the entries of a dedup index that have more than one copy, largest savings first
+    :return: a list of (hex digest, [(archive filename, file name, size), ...]) tuples
+    """
+    duplicates = [(digest, copies) for digest, copies in index.iteritems() if len(copies) > 1]
+    duplicates.sort(key=lambda duplicate: (-duplicate[1][0][2] * (len(duplicate[1]) - 1), duplicate[0]))
+    return duplicates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find files with identical data in .xarc archives. '
+                                     'Archives store every file separately, so duplicates are reported rather than merged.')
+    parser.add_argument('archives', nargs='+', help='Paths to .xarc archives')
+    parser.add_argument('-j', dest='jobs', type=int, default=multiprocessing.cpu_count(), help='Number of archives to hash in parallel. Defaults to the number of CPUs')
+    parser.add_argument('--json', dest='output', type=argparse.FileType('w'), help='Write the duplicate sets as JSON to this file')
+
+    args = parser.parse_args()
+
+    try:
+        index = build_dedup_index(args.archives, max(1, args.jobs))
+    except (XarcDataException, IOError, OSError) as e:
+        sys.exit(e)
+
+    duplicates = duplicate_sets(index)
+    redundant_bytes = 0
+    for digest, copies in duplicates:
+        redundant_bytes += copies[0][2] * (len(copies) - 1)
+        print "{0} ({1} bytes, {2} copies)".format(digest, copies[0][2], len(copies))
+        for archive, name, _ in copies:
+            print "    {0}: {1}".format(archive, name)
+
+    print "{0} unique files, {1} duplicate sets, {2:.1f} MB redundant".format(len(index), len(duplicates), redundant_bytes / 1e6)
+
+    if args.output is not None:
+        json.dump([{'digest': digest, 'size': copies[0][2], 'copies': [[archive, name] for archive, name, _ in copies]}
+                   for digest, copies in duplicates], args.output, indent=4)
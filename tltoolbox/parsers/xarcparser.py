@@ -22,18 +22,183 @@ freely, subject to the following restrictions:
    distribution.
 '''
 
+import argparse
+import itertools
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import os
+import re
 import struct
+import sys
+import tempfile
+import time
 from collections import OrderedDict
+from cStringIO import StringIO
+
+_COPY_CHUNK_SIZE = 1024 * 1024
+_FILE_DESC = re.compile(r'([^\0]*)\0(.{8})', re.S)  # a NUL terminated file name followed by its size and unknown data
 
 
 class XarcDataException(Exception):
     pass
 
 
+class _PathMember(object):
+    """
+    A member whose payload is read from a file on disk when the archive is written
+    """
+    __slots__ = ('path', 'size')
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+
+class _StreamMember(object):
+    """
+    A member whose payload is read from a file like object when the archive is written
+    """
+    __slots__ = ('reader', 'start', 'size')
+
+    def __init__(self, reader, size=None):
+        self.reader = reader
+        self.start = reader.tell()
+        if size is None:
+            reader.seek(0, os.SEEK_END)
+            size = reader.tell() - self.start
+            reader.seek(self.start)
+        self.size = size
+
+
+def _copy_stream(src, dst, size, name):
+    """
+    Copies exactly size bytes from src to dst in bounded chunks
+    """
+    remaining = size
+    while remaining > 0:
+        chunk = src.read(min(remaining, _COPY_CHUNK_SIZE))
+        if not chunk:
+            raise XarcDataException("Data for file '{0}' ended {1} bytes early".format(name, remaining))
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+
+def _kernel_copy(src_fd, dst_fd, offset, size):
+    """
+    Copies size bytes at offset in src_fd to the current position of dst_fd using
+    os.copy_file_range or os.sendfile, so the data never passes through Python.
+    Returns False if neither is available or the platform refuses the copy.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    if copy_file_range is not None:
+        def _copy(offset, count):
+            return copy_file_range(src_fd, dst_fd, count, offset)
+    elif sendfile is not None:
+        def _copy(offset, count):
+            return sendfile(dst_fd, src_fd, offset, count)
+    else:
+        return False
+
+    end = offset + size
+    try:
+        while offset < end:
+            copied = _copy(offset, min(end - offset, 0x7ffff000))
+            if copied == 0:
+                return False
+            offset += copied
+    except OSError:
+        return False
+    return True
+
+
+def member_path(output_dir, filename):
+    """
+    Maps a file name in an archive to a path below output_dir
+    """
+    parts = [part for part in filename.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        raise XarcDataException("Refusing to extract file with unsafe name '{0}'".format(filename))
+    return os.path.join(output_dir, *parts)
+
+
+def replace_mode(filename):
+    """
+    Returns the permission bits for a file about to replace filename: those of the existing file,
+    or the default for new files under the current umask. tempfile.mkstemp creates files readable
+    by their owner only, so temporary files get this mode before they are renamed.
+    """
+    try:
+        return os.stat(filename).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
 class Xarc(object):
     def __init__(self):
         self.unknown = 1
-        self._files = OrderedDict()
+        # file name -> data, or an (offset, size) tuple locating data in the archive file the Xarc was opened from
+        self._files = {}
+        self._names = []  # file names in archive order
+        self._filename = None
+        self._file = None
+        self._mmap = None
+        self._base_offset = None
+        self._update = False
+        self._trace = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_header(self, data, filename):
+        self.unknown, num_files, base_offset = struct.unpack('<3I', data[0:12])
+        if self.unknown != 1:
+            raise XarcDataException("First uint32 in file '{0}' was {1}, expected 1".format(filename, self.unknown))
+        return num_files, base_offset
+
+    @staticmethod
+    def _read_file_descs(data, base_offset):
+        """
+        Parses the file description table. The table is read in one piece and split by a regular expression,
+        sizes are unpacked with a single struct call.
+        :param data: the archive data, a string or an mmap
+        :param base_offset: the offset where the table ends and file data begins
+        :return: a list of file names in archive order and a dict mapping them to (offset, size) tuples
+        """
+        table = data[12:base_offset]
+        file_descs = _FILE_DESC.findall(table)  # order is important señorita...
+        names = [name for name, _ in file_descs]
+        if sum(map(len, names)) + 9 * len(names) != len(table):
+            raise XarcDataException("File description table does not end at file data offset {0}".format(base_offset))
+
+        values = struct.unpack('<{0}I'.format(2 * len(file_descs)), "".join(desc for _, desc in file_descs))
+        sizes = values[0::2]
+        if any(values[1::2]):  # TODO: seems to always be zero, investigate if not
+            for name, unknown in zip(names, values[1::2]):
+                if unknown != 0:
+                    raise XarcDataException("Found non-zero unknown data for file '{0}': {1}".format(name, unknown))
+
+        offsets = []
+        append = offsets.append
+        offset = base_offset
+        for size in sizes:
+            append(offset)
+            offset += size
+
+        return names, dict(itertools.izip(names, itertools.izip(offsets, sizes)))
+
+    @staticmethod
+    def _check_file_count(num_files, names, index):
+        if num_files != len(names):
+            raise XarcDataException("Archive reported {0} files, found {1} files".format(num_files, len(names)))
+        if len(index) != len(names):
+            raise XarcDataException("Archive contains duplicate file names")
 
     def load(self, filename):
         """
@@ -41,70 +206,436 @@ class Xarc(object):
         :param filename: the path to a .xarc file
         """
 
+        self.close()
+
         with open(filename, 'rb') as f:
             data = f.read()
+        self._filename = filename  # names the archive in traces
 
-        self.unknown, num_files, base_offset = struct.unpack('<3I', data[0:12])
-        if self.unknown != 1:
-            raise XarcDataException("First uint32 in file '{0}' was {1}, expected 1".format(filename, self.unknown))
-        i = 12
-        file_descs = OrderedDict()  # order is important señorita...
+        num_files, base_offset = self._read_header(data, filename)
 
-        self._files = OrderedDict()
+        self._files = {}
+        self._names = []
 
-        if base_offset == i:  # no files
+        if base_offset == 12:  # no files
             return
 
-        def _get_file_desc(data, offset):
-            name = ""
-            i = offset
-            c = data[i]
-            i += 1
-            while c != '\0':
-                name += c
-                c = data[i]
-                i += 1
+        names, index = self._read_file_descs(data, base_offset)
+        self._check_file_count(num_files, names, index)
+
+        self._files = dict((name, data[offset:offset + size]) for name, (offset, size) in index.iteritems())
+        self._names = names
+
+    def open(self, filename, update=False):
+        """
+        Opens a .xarc file without reading any file data.
+        Only the header and the file description table are parsed, the archive is kept memory mapped
+        and file data is read on demand by get_data. Call close() (or use the Xarc as a context manager)
+        when done.
+        :param filename: the path to a .xarc file
+        :param update: if True, changes can be written back to the file with flush()
+        """
+
+        self.close()
+
+        f = open(filename, 'r+b' if update else 'rb')
+        try:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            f.close()
+            raise
+        self._file = f
+        self._filename = filename
+        self._update = update
 
-            size, unknown = struct.unpack('<2I', data[i:i + 8])
-            i += 8
+        num_files, base_offset = self._read_header(self._mmap, filename)
+        self._base_offset = base_offset
 
-            if unknown != 0:  # TODO: seems to always be zero, investigate if not
-                raise XarcDataException("Found non-zero unknown data for file '{0}': {1}".format(name, unknown))
-            return i - offset, name, size
+        names, index = self._read_file_descs(self._mmap, base_offset)
+        self._check_file_count(num_files, names, index)
 
-        while i < base_offset:
-            file_desc = _get_file_desc(data, i)
-            file_descs[file_desc[1]] = file_desc[2]
-            i += file_desc[0]
+        end = sum(index[names[-1]]) if names else base_offset
+        if end > len(self._mmap):
+            raise XarcDataException("Archive '{0}' is truncated, expected {1} bytes, found {2} bytes".format(filename, end, len(self._mmap)))
 
-        for name, size in file_descs.iteritems():
-            self._files[name] = data[i:i + size]
-            i += size
+        self._files = index
+        self._names = names
 
-        if num_files != len(self._files):
-            raise XarcDataException("Archive reported {0} files, found {1} files".format(num_files, len(self._files)))
+    def close(self):
+        """
+        Closes an archive opened with open(). Any data returned by get_data without copying is invalidated.
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._filename = None
+        self._base_offset = None
+        self._update = False
+
+    def flush(self):
+        """
+        Writes changes to an archive opened with update=True back to its file.
+        File data that is already in place is left untouched and replaced files that keep their size
+        are overwritten in place, so such a patch costs about as much as the data written. Since file
+        offsets are implied by the order and sizes in the file description table, a replaced file that
+        changes size moves all file data after it, which is rewritten. Adding or renaming files changes
+        the size of the table itself, in which case the whole archive is rewritten.
+        The archive is reopened afterwards, any data returned by get_data without copying is invalidated.
+        """
+        if self._mmap is None or not self._update:
+            raise XarcDataException("Archive is not opened for update")
+
+        filename = self._filename
+        header, descdata = self._build_header()
+        if len(header) + len(descdata) != self._base_offset:
+            self.save(filename)
+            self.open(filename, update=True)
+            return
+
+        writes = []
+        tail = []
+        tail_offset = None
+        offset = self._base_offset
+        for k in self._names:
+            v = self._files[k]
+            if tail_offset is None and isinstance(v, tuple) and v[0] != offset:
+                tail_offset = offset
+            if tail_offset is not None:
+                tail.append((k, v))
+            elif isinstance(v, buffer):
+                # a buffer may point into this archive's own mapping, for example when data returned
+                # by get_data is moved to another file, so it is copied before anything is overwritten
+                writes.append((offset, k, str(v)))
+            elif not isinstance(v, tuple):
+                writes.append((offset, k, v))
+            offset += self.get_file_size(k)
+        end = offset
+
+        f = self._file
+        tail_file = None
+        try:
+            if tail:
+                # moved file data may be read from anywhere in the archive, so the tail is staged
+                # before anything in the file is overwritten
+                tail_file = tempfile.TemporaryFile()
+                for k, v in tail:
+                    self._write_member(tail_file, k, v)
+                tail_file.seek(0)
+
+            f.seek(0)
+            f.write(header)
+            f.write(descdata)
+            for offset, k, v in writes:
+                f.seek(offset)
+                self._write_member(f, k, v)
+
+            if tail_file is not None:
+                f.seek(tail_offset)
+                _copy_stream(tail_file, f, end - tail_offset, filename)
+        finally:
+            if tail_file is not None:
+                tail_file.close()
+
+        f.truncate(end)
+        f.flush()
+        self.open(filename, update=True)
 
     def get_file_names(self):
         if self._files is None:
             return []
 
-        return self._files.keys()
+        return list(self._names)
+
+    def get_file_size(self, filename):
+        data = self._files.get(filename, None)
+        if data is None:
+            return None
+        if isinstance(data, tuple):
+            return data[1]
+        if isinstance(data, (_PathMember, _StreamMember)):
+            return data.size
+        return len(data)
 
-    def get_data(self, filename):
-        return self._files.get(filename, None)
+    def get_file_offset(self, filename):
+        """
+        Returns the offset of a file's data in the archive file it was opened from,
+        or None if there is no such file or its data is not stored in that archive
+        """
+        data = self._files.get(filename, None)
+        if isinstance(data, tuple):
+            return data[0]
+        return None
+
+    def start_trace(self, fileobj):
+        """
+        Starts recording which files are read with get_data or extract, in order, to a trace file
+        suitable for read_trace
+        :param fileobj: a file like object opened for writing text
+        """
+        self._trace = fileobj
+
+    def stop_trace(self):
+        self._trace = None
+
+    def _record_access(self, filename):
+        if self._trace is not None:
+            if self._filename is None:
+                raise XarcDataException("Cannot trace reads from an archive that was not loaded or opened from a file")
+            self._trace.write("{0}\t{1}\n".format(os.path.basename(self._filename), filename))
+
+    def get_data(self, filename, copy=False):
+        """
+        Returns the data of a file in the archive, or None if there is no such file
+        :param filename: the name of the file in the archive
+        :param copy: for opened archives, file data is returned as a buffer into the memory mapped archive
+        unless copy is True, in which case it is read into a new string
+        """
+        data = self._files.get(filename, None)
+        if data is not None:
+            self._record_access(filename)
+        if isinstance(data, tuple):
+            offset, size = data
+            if copy:
+                return self._mmap[offset:offset + size]
+            return buffer(self._mmap, offset, size)
+        elif isinstance(data, _PathMember):
+            with open(data.path, 'rb') as f:
+                return f.read(data.size)
+        elif isinstance(data, _StreamMember):
+            data.reader.seek(data.start)
+            try:
+                return data.reader.read(data.size)
+            finally:
+                data.reader.seek(data.start)
+        return data
+
+    def extract(self, filename, path):
+        """
+        Writes the data of a file in the archive to a file on disk. For opened archives the data is
+        copied from the archive file by the kernel where the platform supports it.
+        :param filename: the name of the file in the archive
+        :param path: the path of the file to write
+        """
+        data = self._files.get(filename, None)
+        if data is None:
+            raise XarcDataException("No such file in archive: '{0}'".format(filename))
+
+        self._record_access(filename)
+        with open(path, 'wb') as f:
+            if isinstance(data, tuple):
+                if _kernel_copy(self._file.fileno(), f.fileno(), data[0], data[1]):
+                    return
+                f.seek(0)
+                f.truncate()
+            self._write_member(f, filename, data)
 
     def insert_data(self, filename, data):
+        self._insert(filename, data)
+
+    def insert_file(self, filename, source, size=None):
+        """
+        Inserts a file whose data is not read until the archive is written
+        :param filename: the name of the file in the archive
+        :param source: a path to a file on disk, or a seekable file like object positioned at the start of the data
+        :param size: the number of bytes to read from a file like object, defaults to the rest of the stream
+        """
+        if isinstance(source, basestring):
+            self._insert(filename, _PathMember(source))
+        else:
+            self._insert(filename, _StreamMember(source, size))
+
+    def _insert(self, filename, data):
+        if filename not in self._files:
+            self._names.append(filename)
         self._files[filename] = data
 
-    def pack(self):
-        filedata = ""
-        descdata = ""
-        for k, v in self._files.iteritems():
+    def _write_member(self, fileobj, filename, data):
+        if isinstance(data, tuple):
+            offset, size = data
+            end = offset + size
+            for i in xrange(offset, end, _COPY_CHUNK_SIZE):
+                fileobj.write(buffer(self._mmap, i, min(_COPY_CHUNK_SIZE, end - i)))
+        elif isinstance(data, _PathMember):
+            with open(data.path, 'rb') as f:
+                _copy_stream(f, fileobj, data.size, filename)
+        elif isinstance(data, _StreamMember):
+            data.reader.seek(data.start)
+            _copy_stream(data.reader, fileobj, data.size, filename)
+        else:
+            fileobj.write(data)
+
+    def reorder(self, filenames):
+        """
+        Changes the order in which file data is laid out in the archive. The given files are moved
+        first, in the given order, other files keep their relative order after them. Names not in the
+        archive are ignored. The new layout is written by save() or write_to().
+        :param filenames: file names in the desired order, for example as returned by read_trace
+        """
+        names = OrderedDict()
+        for filename in filenames:
+            if filename in self._files:
+                names[filename] = None
+        for k in self._names:
+            names.setdefault(k, None)
+        self._names = names.keys()
+
+    def _build_header(self):
+        """
+        Builds the archive header and file description table from the current file sizes
+        """
+        descs = []
+        for k in self._names:
             name = k + "\0"
-            descdata += struct.pack('<{0}s2I'.format(len(name)), name, len(v), 0)  # 0 is the unknown data in a file description
-            filedata += v
+            descs.append(struct.pack('<{0}s2I'.format(len(name)), name, self.get_file_size(k), 0))  # 0 is the unknown data in a file description
+        descdata = "".join(descs)
 
         base_offset = 12 + len(descdata)
 
-        data = struct.pack('<3I', self.unknown, len(self._files), base_offset) + descdata + filedata
-        return data
+        return struct.pack('<3I', self.unknown, len(self._files), base_offset), descdata
+
+    def write_to(self, fileobj):
+        """
+        Writes the archive to a file like object.
+        The file description table is built from the file sizes up front, file data is then streamed
+        to fileobj one file at a time without building the archive in memory.
+        :param fileobj: a writable file like object
+        """
+        header, descdata = self._build_header()
+        fileobj.write(header)
+        fileobj.write(descdata)
+        for k in self._names:
+            self._write_member(fileobj, k, self._files[k])
+
+    def save(self, filename):
+        """
+        Writes the archive to a file. The archive is written to a temporary file next to filename which
+        then replaces it, so it is safe to save an opened archive over its own file.
+        :param filename: the path to write the .xarc file to
+        """
+        fd, tmp_filename = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.write_to(f)
+            os.chmod(tmp_filename, replace_mode(filename))
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp_filename, filename)
+        except Exception:
+            os.remove(tmp_filename)
+            raise
+
+    def pack(self):
+        f = StringIO()
+        self.write_to(f)
+        return f.getvalue()
+
+
+def read_trace(fileobj, archive=None):
+    """
+    Reads a trace recorded with Xarc.start_trace
+    :param fileobj: a file like object opened for reading text
+    :param archive: if given, only accesses to archives with this file name are returned
+    :return: the accessed file names in order of first access
+    """
+    if archive is not None:
+        archive = os.path.basename(archive)
+
+    filenames = OrderedDict()
+    for line in fileobj:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        traced_archive, _, filename = line.partition('\t')
+        if archive is None or traced_archive == archive:
+            filenames[filename] = None
+    return filenames.keys()
+
+
+def extract_archive(filename, output_dir):
+    """
+    Extracts all files in an archive below output_dir. Files that already exist with the same size
+    and the modification time of the archive are skipped, extracted files get the archive's modification time.
+    :return: a (filename, extracted files, skipped files, extracted bytes, seconds) tuple
+    """
+    start = time.time()
+    mtime = os.stat(filename).st_mtime
+    extracted = skipped = extracted_bytes = 0
+
+    with Xarc() as xarc:
+        xarc.open(filename)
+        for name in xarc.get_file_names():
+            path = member_path(output_dir, name)
+            size = xarc.get_file_size(name)
+            try:
+                st = os.stat(path)
+                if st.st_size == size and int(st.st_mtime) == int(mtime):
+                    skipped += 1
+                    continue
+            except OSError:
+                pass
+
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:  # created concurrently
+                    if not os.path.isdir(dirname):
+                        raise
+
+            xarc.extract(name, path)
+            os.utime(path, (time.time(), mtime))
+            extracted += 1
+            extracted_bytes += size
+
+    return filename, extracted, skipped, extracted_bytes, time.time() - start
+
+
+def _extract_archive_task(args):
+    return extract_archive(*args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tools for .xarc archives')
+    subparsers = parser.add_subparsers(dest='command')
+
+    extract = subparsers.add_parser('extract', help='Extract the files in one or more archives')
+    extract.add_argument('archives', nargs='+', help='Paths to .xarc archives')
+    extract.add_argument('-o', dest='output', required=True, help='Output root directory, each archive is extracted to a directory named after it')
+    extract.add_argument('-j', dest='jobs', type=int, default=multiprocessing.cpu_count(), help='Number of archives to extract in parallel. Defaults to the number of CPUs')
+    extract.add_argument('--threads', action='store_true', help='Use threads instead of processes')
+
+    repack = subparsers.add_parser('repack', help='Rewrite an archive with its file data ordered by a trace of file accesses')
+    repack.add_argument('archive', help='Path to a .xarc archive')
+    repack.add_argument('--trace', required=True, type=argparse.FileType('r'), help='Trace file recorded with Xarc.start_trace')
+    repack.add_argument('-o', dest='output', help='Output path. If unspecified, the archive is rewritten in place')
+
+    args = parser.parse_args()
+
+    if args.command == 'extract':
+        tasks = [(archive, os.path.join(args.output, os.path.splitext(os.path.basename(archive))[0])) for archive in args.archives]
+        pool = (multiprocessing.pool.ThreadPool if args.threads else multiprocessing.Pool)(max(1, args.jobs))
+        try:
+            total_bytes = 0
+            start = time.time()
+            for archive, extracted, skipped, extracted_bytes, seconds in pool.imap_unordered(_extract_archive_task, tasks):
+                total_bytes += extracted_bytes
+                print "{0}: {1} files extracted, {2} skipped, {3:.1f} MB in {4:.2f} s ({5:.1f} MB/s)".format(
+                    archive, extracted, skipped, extracted_bytes / 1e6, seconds, extracted_bytes / 1e6 / max(seconds, 1e-6))
+            seconds = time.time() - start
+            print "Total: {0:.1f} MB in {1:.2f} s ({2:.1f} MB/s)".format(total_bytes / 1e6, seconds, total_bytes / 1e6 / max(seconds, 1e-6))
+        except (XarcDataException, IOError, OSError) as e:
+            pool.terminate()
+            sys.exit(e)
+        pool.close()
+        pool.join()
+
+    elif args.command == 'repack':
+        with Xarc() as xarc:
+            xarc.open(args.archive)
+            filenames = read_trace(args.trace, args.archive)
+            xarc.reorder(filenames)
+            xarc.save(args.output or args.archive)
+        print "{0}: {1} traced files moved first".format(args.archive, len(filenames))
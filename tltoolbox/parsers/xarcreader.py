@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+import os
+import threading
+
+from xarcparser import Xarc, XarcDataException
+
+
+class _ReadRequest(object):
+    __slots__ = ('offset', 'size', 'data', 'error', 'done')
+
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.size = size
+        self.data = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class XarcReader(object):
+    """
+    A thread-safe reader for the files in an archive.
+    File data is read with positioned reads on one shared file descriptor, so threads do not contend
+    for a file position. Where os.pread is missing, as on Python 2, each reading thread seeks on a file
+    descriptor of its own instead. At most max_concurrent_reads reads are in flight at a time, requests arriving
+    while all of them are busy are queued and served together, merging requests for adjacent files
+    into single larger reads.
+    """
+
+    def __init__(self, filename, max_concurrent_reads=4, max_gap=64 * 1024, max_read_size=4 * 1024 * 1024):
+        """
+        :param filename: the path to a .xarc file
+        :param max_concurrent_reads: the number of threads that may read from the file at the same time
+        :param max_gap: requests are merged if the data between them is no larger than this
+        :param max_read_size: merged reads are not grown beyond this size
+        """
+        with Xarc() as xarc:
+            xarc.open(filename)
+            self._index = dict((name, (xarc.get_file_offset(name), xarc.get_file_size(name))) for name in xarc.get_file_names())
+
+        self._filename = filename
+        self._fd = None  # the shared descriptor for positioned reads, without os.pread each thread opens its own
+        if hasattr(os, 'pread'):
+            self._fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self._closed = False
+        self._max_concurrent_reads = max_concurrent_reads
+        self._max_gap = max_gap
+        self._max_read_size = max_read_size
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread_fds = []  # the descriptors opened by reading threads without os.pread
+        self._pending = []
+        self._active_reads = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            for fd in self._thread_fds:
+                os.close(fd)
+            self._thread_fds = []
+            self._local = threading.local()
+
+    def _check_open(self):
+        if self._closed:
+            raise XarcDataException("Archive '{0}' is closed".format(self._filename))
+
+    def get_file_names(self):
+        return self._index.keys()
+
+    def _thread_fd(self):
+        """
+        Returns the file descriptor of the calling thread, opening it on first use
+        """
+        fd = getattr(self._local, 'fd', None)
+        if fd is None:
+            fd = os.open(self._filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            with self._lock:
+                if self._closed:
+                    os.close(fd)
+                    self._check_open()
+                self._thread_fds.append(fd)
+            self._local.fd = fd
+        return fd
+
+    def _pread(self, offset, size):
+        pread = getattr(os, 'pread', None)
+        if pread is not None:
+            fd = self._fd
+            if fd is None:
+                self._check_open()
+        else:
+            fd = self._thread_fd()
+            os.lseek(fd, offset, os.SEEK_SET)
+
+            def pread(fd, size, offset):
+                return os.read(fd, size)
+
+        chunks = []
+        while size > 0:
+            chunk = pread(fd, size, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        data = "".join(chunks)
+
+        if size > 0:
+            raise XarcDataException("Archive '{0}' is truncated".format(self._filename))
+        return data
+
+    def _serve(self, requests):
+        """
+        Serves requests, merging those for adjacent data into single reads
+        """
+        requests = sorted(requests, key=lambda request: request.offset)
+        i = 0
+        while i < len(requests):
+            start = requests[i].offset
+            end = start + requests[i].size
+            j = i + 1
+            while j < len(requests):
+                request = requests[j]
+                request_end = max(end, request.offset + request.size)
+                if request.offset - end > self._max_gap or request_end - start > self._max_read_size:
+                    break
+                end = request_end
+                j += 1
+
+            batch = requests[i:j]
+            try:
+                data = self._pread(start, end - start)
+                for request in batch:
+                    request.data = data[request.offset - start:request.offset - start + request.size]
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            for request in batch:
+                request.done.set()
+            i = j
+
+    def _request(self, filename):
+        self._check_open()
+        entry = self._index.get(filename, None)
+        if entry is None:
+            raise XarcDataException("No such file in archive: '{0}'".format(filename))
+        return _ReadRequest(*entry)
+
+    def read(self, filename):
+        """
+        Returns the data of a file in the archive. Safe to call from several threads.
+        """
+        request = self._request(filename)
+
+        with self._lock:
+            self._pending.append(request)
+            serving = self._active_reads < self._max_concurrent_reads
+            if serving:
+                self._active_reads += 1
+
+        if serving:
+            # serve queued requests, including our own, until the queue is drained
+            while True:
+                with self._lock:
+                    batch = self._pending
+                    self._pending = []
+                    if not batch:
+                        self._active_reads -= 1
+                        break
+                self._serve(batch)
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.data
+
+    def read_many(self, filenames):
+        """
+        Returns the data of several files as a list in the same order, merging reads of adjacent files
+        """
+        requests = [self._request(filename) for filename in filenames]
+        self._serve(requests)
+        for request in requests:
+            if request.error is not None:
+                raise request.error
+        return [request.data for request in requests]
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (c) 2013 Victor Wåhlström
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+'''
+
+import os
+from cStringIO import StringIO
+
+from xarcparser import Xarc
+
+
+class XarcVFSException(Exception):
+    pass
+
+
+def _normalize(path):
+    return path.replace('\\', '/').strip('/')
+
+
+class XarcVFS(object):
+    """
+    A read-only file system merging several .xarc archives and loose directories.
+    Sources mounted with a higher priority override files in sources with a lower priority,
+    sources with the same priority are searched in mount order with the last mounted winning.
+    Archives are opened index only, name resolution is a single lookup in a merged index.
+    """
+
+    def __init__(self):
+        self._mounts = []  # (priority, mount order, source)
+        self._index = None
+        self._dirs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for _, _, source in self._mounts:
+            if isinstance(source, Xarc):
+                source.close()
+        self._mounts = []
+        self._index = None
+        self._dirs = None
+
+    def mount_archive(self, filename, priority=0):
+        """
+        Mounts a .xarc archive, its files appear in the root of the file system
+        """
+        xarc = Xarc()
+        xarc.open(filename)
+        self._mounts.append((priority, len(self._mounts), xarc))
+        self._index = None
+
+    def mount_directory(self, path, priority=0):
+        """
+        Mounts a directory of loose files, typically used for overrides
+        """
+        if not os.path.isdir(path):
+            raise XarcVFSException("Not a directory: '{0}'".format(path))
+        self._mounts.append((priority, len(self._mounts), os.path.abspath(path)))
+        self._index = None
+
+    def _build_index(self):
+        index = {}
+        for _, _, source in sorted(self._mounts):
+            if isinstance(source, Xarc):
+                for name in source.get_file_names():
+                    index[_normalize(name)] = (source, name)
+            else:
+                for dirpath, _, filenames in os.walk(source):
+                    for filename in filenames:
+                        path = os.path.join(dirpath, filename)
+                        index[_normalize(os.path.relpath(path, source))] = (None, path)
+
+        dirs = {'': set()}
+        for name in index:
+            while name:
+                parent, _, child = name.rpartition('/')
+                entries = dirs.setdefault(parent, set())
+                if child in entries:  # parent directories are already known
+                    break
+                entries.add(child)
+                name = parent
+
+        self._index = index
+        self._dirs = dirs
+
+    def _resolve(self, path):
+        if self._index is None:
+            self._build_index()
+        return self._index.get(_normalize(path), None)
+
+    def exists(self, path):
+        if self._resolve(path) is not None:
+            return True
+        return _normalize(path) in self._dirs
+
+    def isdir(self, path):
+        if self._index is None:
+            self._build_index()
+        return _normalize(path) in self._dirs
+
+    def listdir(self, path=''):
+        """
+        Returns the sorted names of the files and directories in a directory
+        """
+        if self._index is None:
+            self._build_index()
+        entries = self._dirs.get(_normalize(path), None)
+        if entries is None:
+            raise XarcVFSException("No such directory: '{0}'".format(path))
+        return sorted(entries)
+
+    def read(self, path):
+        """
+        Returns the data of a file as a string
+        """
+        entry = self._resolve(path)
+        if entry is None:
+            raise XarcVFSException("No such file: '{0}'".format(path))
+
+        xarc, name = entry
+        if xarc is None:
+            with open(name, 'rb') as f:
+                return f.read()
+        return xarc.get_data(name, copy=True)
+
+    def open(self, path):
+        """
+        Returns a read-only file like object for a file
+        """
+        entry = self._resolve(path)
+        if entry is None:
+            raise XarcVFSException("No such file: '{0}'".format(path))
+
+        xarc, name = entry
+        if xarc is None:
+            return open(name, 'rb')
+        return StringIO(xarc.get_data(name, copy=True))  # a buffer into the mapped archive dies with it